@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+DEDUP_SHINGLE_SIZE = 5 # characters per shingle
+# the MinHash signature of a post has DEDUP_NUM_BANDS * DEDUP_ROWS_PER_BAND hashes; with 16 bands of 4,
+# posts that share more than about half their shingles usually land in the same bucket of at least one band
+DEDUP_NUM_BANDS = 16
+DEDUP_ROWS_PER_BAND = 4
+# the fraction of signature hashes two posts in the same bucket must share to count as near-duplicates (an estimate of their Jaccard similarity)
+DEDUP_SIMILARITY_THRESHOLD = 0.8
+DEDUP_CHUNK_SIZE = 1000000 # the most shingles hashed at once
+DEDUP_REPORT_COLUMNS = ["sentence", "score", "kept_sentence", "kept_score", "reason", "similarity"]
+
+
+def normalize_text(texts):
+    """
+    Lowercases texts and turns every run of characters that aren't letters or digits into a single space,
+    so that posts that only differ in case, punctuation or spacing become the same text.
+    Like tokenizer.normalize_sentences, the texts are made an object column first, so that \\W gets matched by Python's re and knows non-ASCII letters
+    Args:
+        texts: a pandas series of strings
+    Returns:
+        A pandas series of strings
+    """
+    return texts.astype(object).str.lower().str.replace(r"[\W_]+", " ", regex=True).str.strip()
+
+def mix_hashes(hashes):
+    """
+    Scrambles the bits of uint64 hashes (the splitmix64 finalizer), so that similar inputs get unrelated hashes
+    """
+    hashes = hashes ^ (hashes >> np.uint64(30))
+    hashes = hashes * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = hashes ^ (hashes >> np.uint64(27))
+    hashes = hashes * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+def get_minhash_signatures(texts, num_hashes=DEDUP_NUM_BANDS * DEDUP_ROWS_PER_BAND, shingle_size=DEDUP_SHINGLE_SIZE, seed=0):
+    """
+    Computes the MinHash signature of every text over its character shingles, in time linear in the total length of the texts.
+    The fraction of hashes two signatures share estimates the Jaccard similarity of the shingles of their texts.
+    Args:
+        texts: a pandas series of strings
+        num_hashes: the length of a signature
+        shingle_size: the number of characters per shingle; shorter texts count as one shingle
+        seed: the seed of the hash functions, so that the same texts always get the same signatures
+    Returns:
+        A uint32 numpy matrix with one signature per row
+    """
+    rng = np.random.default_rng(seed)
+    # multiply-shift hash functions: the top 32 bits of (a * x + b) mod 2^64, with odd a
+    multipliers = rng.integers(0, 2 ** 63, size=num_hashes, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    increments = rng.integers(0, 2 ** 63, size=num_hashes, dtype=np.uint64)
+
+    # every text is padded to at least one shingle and laid out in one byte array, with offsets[i] where text i starts
+    encoded_texts = [text.encode("utf-8") for text in texts.str.pad(shingle_size, side="right")]
+    text_lengths = np.array([len(encoded_text) for encoded_text in encoded_texts], dtype=np.int64)
+    offsets = np.zeros(len(encoded_texts) + 1, dtype=np.int64)
+    np.cumsum(text_lengths, out=offsets[1:])
+    text_bytes = np.frombuffer(b"".join(encoded_texts), dtype=np.uint8).astype(np.uint64)
+
+    # a polynomial hash of the shingle starting at every byte, for all the bytes at once
+    rolling_hashes = np.zeros(max(len(text_bytes) - shingle_size + 1, 0), dtype=np.uint64)
+    for position in range(shingle_size):
+        rolling_hashes = rolling_hashes * np.uint64(1099511628211) + text_bytes[position:position + len(rolling_hashes)]
+
+    signatures = np.empty((len(encoded_texts), num_hashes), dtype=np.uint32)
+    num_shingles = text_lengths - shingle_size + 1
+    text_start = 0
+    while text_start < len(encoded_texts):
+        # as many texts as fit in DEDUP_CHUNK_SIZE shingles, and at least one
+        text_end = max(text_start + 1, int(np.searchsorted(np.cumsum(num_shingles[text_start:]), DEDUP_CHUNK_SIZE, side="right")) + text_start)
+        chunk_counts = num_shingles[text_start:text_end]
+        chunk_starts = np.zeros(len(chunk_counts), dtype=np.int64)
+        np.cumsum(chunk_counts[:-1], out=chunk_starts[1:])
+        # the position of every shingle of the chunk's texts: text i has a shingle at each of offsets[i] to offsets[i + 1] - shingle_size
+        positions = np.repeat(offsets[text_start:text_end] - chunk_starts, chunk_counts) + np.arange(chunk_counts.sum())
+        shingle_hashes = mix_hashes(rolling_hashes[positions])
+        for hash_index in range(num_hashes):
+            permuted = ((shingle_hashes * multipliers[hash_index] + increments[hash_index]) >> np.uint64(32)).astype(np.uint32)
+            signatures[text_start:text_end, hash_index] = np.minimum.reduceat(permuted, chunk_starts)
+        text_start = text_end
+    return signatures
+
+def get_near_duplicate_clusters(signatures, num_bands=DEDUP_NUM_BANDS, similarity_threshold=DEDUP_SIMILARITY_THRESHOLD):
+    """
+    Groups rows into clusters of near-duplicates with locality-sensitive hashing: rows whose signatures agree on every hash of a band share a bucket,
+    and every row gets linked with the first row of each of its buckets if their signatures are similar enough.
+    Clusters are the connected groups of links, so they are found in linear time, however big a bucket gets.
+    Args:
+        signatures: a matrix from get_minhash_signatures
+        num_bands: the number of bands the signatures are split into
+        similarity_threshold: the fraction of hashes two rows must share to get linked
+    Returns:
+        A numpy array with the cluster of every row
+    """
+    num_rows, num_hashes = signatures.shape
+    rows_per_band = num_hashes // num_bands
+    linked_rows = []
+    linked_first_rows = []
+    for band in range(num_bands):
+        band_hashes = np.ascontiguousarray(signatures[:, band * rows_per_band:(band + 1) * rows_per_band])
+        # every band of a signature viewed as one opaque value, so np.unique can group the equal ones
+        band_keys = band_hashes.view(np.dtype((np.void, band_hashes.dtype.itemsize * rows_per_band))).ravel()
+        _, first_rows, buckets = np.unique(band_keys, return_index=True, return_inverse=True)
+        first_rows = first_rows[buckets.ravel()]
+        candidates = np.nonzero(first_rows != np.arange(num_rows))[0]
+        similarities = np.mean(signatures[candidates] == signatures[first_rows[candidates]], axis=1)
+        similar = similarities >= similarity_threshold
+        linked_rows.append(candidates[similar])
+        linked_first_rows.append(first_rows[candidates[similar]])
+
+    linked_rows = np.concatenate(linked_rows)
+    links = coo_matrix((np.ones(len(linked_rows), dtype=np.int8), (linked_rows, np.concatenate(linked_first_rows))), shape=(num_rows, num_rows))
+    _, clusters = connected_components(links, directed=False)
+    return clusters
+
+def get_exact_keys(normalized_texts):
+    """
+    Returns:
+        A uint64 numpy array with a hash of every normalized text, equal for texts that are exact duplicates
+    """
+    return pd.util.hash_pandas_object(normalized_texts, index=False).to_numpy()
+
+def create_dedup_state():
+    """
+    Returns:
+        The state add_dedup_chunk fills in a chunk of posts at a time, so that only the signatures, ids and scores of the posts are held in memory:
+            "text_ids": a list of arrays with the id of the distinct normalized text of every post
+            "scores": a list of arrays with the score of every post
+            "signatures": a list of MinHash signature matrices, with a row per distinct normalized text, in the order of the text ids
+            "text_ids_by_key": a dictionary mapping the exact key (see get_exact_keys) of every distinct normalized text seen so far to its text id
+    """
+    return {"text_ids": [], "scores": [], "signatures": [], "text_ids_by_key": {}}
+
+def add_dedup_chunk(dedup_state, texts, scores):
+    """
+    Adds a chunk of posts to a dedup state (see create_dedup_state). Every distinct normalized text only gets a MinHash signature once,
+    so exact duplicates cost an id and a score, however many chunks they are spread over
+    Args:
+        dedup_state: the state returned by create_dedup_state
+        texts: a pandas series with the text of every post of the chunk; a missing text counts as an empty one
+        scores: a pandas series with the score of every post of the chunk
+    """
+    # astype(str) keeps missing values missing in pandas 3, and they have no text to hash
+    normalized_texts = normalize_text(texts.fillna("").astype(str))
+    chunk_keys, first_rows, chunk_text_ids = np.unique(get_exact_keys(normalized_texts), return_index=True, return_inverse=True)
+    text_ids_by_key = dedup_state["text_ids_by_key"]
+    text_ids = np.empty(len(chunk_keys), dtype=np.int64)
+    new_texts = []
+    for position, key in enumerate(chunk_keys.tolist()):
+        text_id = text_ids_by_key.get(key)
+        if text_id is None:
+            text_id = text_ids_by_key[key] = len(text_ids_by_key)
+            new_texts.append(position)
+        text_ids[position] = text_id
+    dedup_state["signatures"].append(get_minhash_signatures(normalized_texts.iloc[first_rows[new_texts]]))
+    dedup_state["text_ids"].append(text_ids[chunk_text_ids.ravel()])
+    dedup_state["scores"].append(scores.fillna(-np.inf).to_numpy(dtype=np.float64))
+
+def get_duplicate_keepers(dedup_state, similarity_threshold=DEDUP_SIMILARITY_THRESHOLD):
+    """
+    Finds, for every post added to a dedup state, the post that is kept in its place: the copy with the highest score of its group of 
+    exact duplicates (after normalize_text) and near-duplicates (see get_near_duplicate_clusters); ties go to the copy that comes first
+    Args:
+        dedup_state: the state filled by add_dedup_chunk
+        similarity_threshold: see get_near_duplicate_clusters
+    Returns:
+        A tuple (keepers, removed, is_exact, similarities):
+            keepers: a numpy array with the row of the post kept in place of every post, which is the post itself for the posts that are kept
+            removed: a numpy array with the rows of the posts that are removed, from the highest score to the lowest
+            is_exact: a boolean numpy array telling, for every removed post, if it's an exact duplicate of its keeper
+            similarities: a numpy array with the similarity of every removed post with its keeper (1 for exact duplicates)
+    """
+    text_ids = np.concatenate(dedup_state["text_ids"]) if dedup_state["text_ids"] else np.zeros(0, dtype=np.int64)
+    scores = np.concatenate(dedup_state["scores"]) if dedup_state["scores"] else np.zeros(0)
+    num_rows = len(text_ids)
+    if num_rows == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool), np.zeros(0)
+    signatures = np.concatenate(dedup_state["signatures"])
+    # ranks sort the posts so that the first copy of every group is the one to keep
+    order = np.argsort(-scores, kind="stable")
+    ranks = np.empty(num_rows, dtype=np.int64)
+    ranks[order] = np.arange(num_rows)
+
+    # the exact duplicates of a text are kept as its best ranked copy
+    text_ranks = np.full(len(signatures), num_rows, dtype=np.int64)
+    np.minimum.at(text_ranks, text_ids, ranks)
+    # texts go through LSH in the order of their best copies, so that the first row of a bucket is always the best ranked one
+    text_order = np.argsort(text_ranks, kind="stable")
+    clusters = get_near_duplicate_clusters(signatures[text_order], similarity_threshold=similarity_threshold)
+    cluster_ranks = np.full(clusters.max() + 1, num_rows, dtype=np.int64)
+    np.minimum.at(cluster_ranks, clusters, text_ranks[text_order])
+    near_keeper_ranks = np.empty(len(signatures), dtype=np.int64)
+    near_keeper_ranks[text_order] = cluster_ranks[clusters]
+
+    keepers = order[near_keeper_ranks[text_ids]]
+    removed = order[keepers[order] != order]
+    exact_keepers = order[text_ranks[text_ids[removed]]]
+    # a post removed for an exact duplicate of a post that a near-duplicate removed in turn counts as near
+    is_exact = exact_keepers == keepers[removed]
+    similarities = np.where(
+        is_exact, 1.0, np.mean(signatures[text_ids[removed]] == signatures[text_ids[keepers[removed]]], axis=1))
+    return keepers, removed, is_exact, similarities
+
+def get_dedup_report(removed, keepers, is_exact, similarities, texts, scores):
+    """
+    Returns:
+        A dataframe with the DEDUP_REPORT_COLUMNS and a row per removed post (see get_duplicate_keepers),
+        where texts and scores map a row to the text and score of its post
+    """
+    return pd.DataFrame({
+        "sentence": [texts[row] for row in removed],
+        "score": [scores[row] for row in removed],
+        "kept_sentence": [texts[row] for row in keepers[removed]],
+        "kept_score": [scores[row] for row in keepers[removed]],
+        "reason": np.where(is_exact, "exact", "near"),
+        "similarity": similarities
+    }, columns=DEDUP_REPORT_COLUMNS)
+
+def deduplicate_posts(posts, text_column="sentence", score_column="score", similarity_threshold=DEDUP_SIMILARITY_THRESHOLD):
+    """
+    Removes exact duplicates (after normalize_text) and near-duplicates (see get_near_duplicate_clusters) from posts,
+    keeping the copy with the highest score of every group; ties go to the copy that comes first
+    Args:
+        posts: a dataframe with a text_column and a score_column
+        text_column: the column of the text of the posts
+        score_column: the column of the score of the posts
+        similarity_threshold: see get_near_duplicate_clusters
+    Returns:
+        A tuple (kept_posts, report): the posts that are kept, in their original order,
+        and a dataframe with a row per post that was removed, with the DEDUP_REPORT_COLUMNS
+    """
+    if len(posts) == 0:
+        return posts, pd.DataFrame(columns=DEDUP_REPORT_COLUMNS)
+    dedup_state = create_dedup_state()
+    add_dedup_chunk(dedup_state, posts[text_column], posts[score_column])
+    keepers, removed, is_exact, similarities = get_duplicate_keepers(dedup_state, similarity_threshold)
+    report = get_dedup_report(
+        removed, keepers, is_exact, similarities, posts[text_column].to_numpy(), posts[score_column].to_numpy())
+    kept_posts = posts.iloc[np.nonzero(keepers == np.arange(len(posts)))[0]]
+    return kept_posts, report
@@ -0,0 +1,187 @@
+from os.path import join, exists
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from feature_cache import hash_sentences
+from sqlite_store import open_sqlite_store, read_sqlite_store, write_sqlite_store
+
+
+# using this library for the model: https://huggingface.co/sentence-transformers/all-mpnet-base-v2
+# errors with installing the sentence_transformers library can be solved with this solution: https://github.com/UKPLab/sentence-transformers/issues/128
+EMBEDDING_MODEL_NAME = 'all-mpnet-base-v2'
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_CACHE_DIR = "embedding_cache"
+EMBEDDING_CACHE_FILENAME = "embeddings.sqlite"
+EMBEDDING_PROGRESS_EVERY = 100 # batches between progress messages
+# an embedding store is a raw {name}.npy matrix, opened memory-mapped, next to a {name}_sentences.parquet table with the sentence of every row
+EMBEDDING_STORE_SENTENCES_SUFFIX = "_sentences.parquet"
+# the key of the model name in the metadata of the sentence table; stores written before it was recorded were all embedded with EMBEDDING_MODEL_NAME
+EMBEDDING_STORE_MODEL_KEY = b"model_name"
+# the sentence transformer models loaded so far by this process, keyed by name
+embedding_models = {}
+
+
+def get_embedding_model(model_name=EMBEDDING_MODEL_NAME):
+    """
+    Loads a sentence transformer model once per process
+    """
+    if model_name not in embedding_models:
+        # imported here so that the rest of the pipeline doesn't need sentence_transformers installed
+        from sentence_transformers import SentenceTransformer
+        embedding_models[model_name] = SentenceTransformer(model_name)
+    return embedding_models[model_name]
+
+def open_embedding_cache(model_name=EMBEDDING_MODEL_NAME, cache_dir=EMBEDDING_CACHE_DIR):
+    """
+    Opens the on-disk table of sentence embeddings computed so far, keyed by model name and sentence hash
+    Returns:
+        The sqlite store (see sqlite_store.open_sqlite_store) that embeddings are read and written under the model name in
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    return open_sqlite_store(join(cache_dir, EMBEDDING_CACHE_FILENAME), "embeddings", "model_name", "embedding", "BLOB", model_name)
+
+def read_cached_embeddings(embedding_cache, sentence_hashes):
+    """
+    Looks sentences up in the embedding cache
+    Args:
+        embedding_cache: the cache returned by open_embedding_cache
+        sentence_hashes: an iterable of sentence hashes (str)
+    Returns:
+        A dictionary, where the keys (str) are the hashes of the sentences that were found and values are their float32 embeddings
+    """
+    return {
+        sentence_hash: np.frombuffer(embedding, dtype=np.float32) 
+        for sentence_hash, embedding in read_sqlite_store(embedding_cache, sentence_hashes).items()}
+
+def write_cached_embeddings(embedding_cache, embeddings):
+    """
+    Adds embeddings to the embedding cache; they are always stored as float32
+    Args:
+        embedding_cache: the cache returned by open_embedding_cache
+        embeddings: a dictionary, where the keys (str) are sentence hashes and values are their embeddings
+    """
+    write_sqlite_store(embedding_cache, {
+        sentence_hash: np.asarray(embedding, dtype=np.float32).tobytes() for sentence_hash, embedding in embeddings.items()})
+
+def get_sentence_embeddings(sentences, model_name=EMBEDDING_MODEL_NAME, batch_size=EMBEDDING_BATCH_SIZE, dtype=np.float32, cache_dir=EMBEDDING_CACHE_DIR):
+    """
+    Embeds sentences in batches, only encoding the ones that aren't in the embedding cache yet.
+    Sentences get sorted by length before batching, so that each batch pads its sentences as little as possible.
+    Args:
+        sentences: a list of strings
+        model_name: the sentence transformer model to embed with
+        batch_size: the number of sentences per call to model.encode
+        dtype: the dtype of the returned matrix, np.float32 or np.float16
+        cache_dir: the directory of the embedding cache
+    Returns:
+        A contiguous numpy matrix with one row per sentence, in the same order as the sentences
+    """
+    sentence_hashes = hash_sentences(sentences)
+    embedding_cache = open_embedding_cache(model_name, cache_dir)
+    embeddings = read_cached_embeddings(embedding_cache, set(sentence_hashes))
+
+    new_sentences = {}
+    for sentence, sentence_hash in zip(sentences, sentence_hashes):
+        if sentence_hash not in embeddings and sentence_hash not in new_sentences:
+            new_sentences[sentence_hash] = sentence
+    print(f"found {len(embeddings)} embeddings in the cache, encoding {len(new_sentences)} new sentences...")
+
+    if len(new_sentences) > 0:
+        model = get_embedding_model(model_name)
+        new_hashes = sorted(new_sentences, key=lambda sentence_hash: len(new_sentences[sentence_hash]))
+        num_batches = -(-len(new_hashes) // batch_size)
+        for batch_number, start in enumerate(range(0, len(new_hashes), batch_size)):
+            batch_hashes = new_hashes[start:start + batch_size]
+            batch_embeddings = model.encode(
+                [new_sentences[sentence_hash] for sentence_hash in batch_hashes],
+                batch_size=len(batch_hashes),
+                convert_to_numpy=True)
+            new_embeddings = dict(zip(batch_hashes, batch_embeddings.astype(np.float32)))
+            write_cached_embeddings(embedding_cache, new_embeddings)
+            embeddings.update(new_embeddings)
+            if (batch_number + 1) % EMBEDDING_PROGRESS_EVERY == 0 or batch_number + 1 == num_batches:
+                print(f"encoded {batch_number + 1} of {num_batches} batches")
+    embedding_cache["connection"].close()
+
+    if len(sentences) == 0:
+        return np.zeros((0, 0), dtype=dtype)
+    sentence_embeddings = np.empty((len(sentences), len(embeddings[sentence_hashes[0]])), dtype=dtype)
+    for row, sentence_hash in enumerate(sentence_hashes):
+        sentence_embeddings[row] = embeddings[sentence_hash]
+    return sentence_embeddings
+
+def write_embedding_store(store_path, sentences, embeddings, dtype=np.float32, model_name=EMBEDDING_MODEL_NAME):
+    """
+    Saves embeddings as an embedding store, see read_embedding_store
+    Args:
+        store_path: the path of the store without extension; the matrix goes to {store_path}.npy and the sentences to {store_path}_sentences.parquet
+        sentences: a list of strings
+        embeddings: a numpy matrix with one row per sentence
+        dtype: the dtype the matrix is stored as, np.float32 or np.float16
+        model_name: the sentence transformer model the embeddings come from, recorded in the metadata of the sentence table
+    """
+    # written to temporary files first, so that an interrupted write never leaves a half-written store behind
+    with open(store_path + ".npy.tmp", "wb") as matrix_file:
+        np.save(matrix_file, np.ascontiguousarray(embeddings, dtype=dtype))
+    sentence_table = pa.Table.from_pandas(pd.DataFrame({
+        "id": np.arange(len(sentences)), 
+        "sentence": sentences, 
+        "sentence_hash": hash_sentences(sentences)
+    }), preserve_index=False)
+    sentence_table = sentence_table.replace_schema_metadata({
+        **(sentence_table.schema.metadata or {}), EMBEDDING_STORE_MODEL_KEY: model_name.encode("utf-8")})
+    pq.write_table(sentence_table, store_path + EMBEDDING_STORE_SENTENCES_SUFFIX + ".tmp")
+    os.replace(store_path + ".npy.tmp", store_path + ".npy")
+    os.replace(store_path + EMBEDDING_STORE_SENTENCES_SUFFIX + ".tmp", store_path + EMBEDDING_STORE_SENTENCES_SUFFIX)
+
+def read_embedding_store(store_path):
+    """
+    Opens an embedding store without reading its matrix: the rows get paged in from disk as they are used, 
+    so opening is instant and slices of the matrix are zero-copy views
+    Args:
+        store_path: the path of the store without extension, see write_embedding_store
+    Returns:
+        A dictionary with the "sentences" (a list of strings), their read-only memory-mapped "embeddings" matrix 
+        and the "model_name" (str) they were embedded with, or None if there is no store at store_path
+    """
+    if not exists(store_path + ".npy") or not exists(store_path + EMBEDDING_STORE_SENTENCES_SUFFIX):
+        return None
+    sentence_table = pq.read_table(store_path + EMBEDDING_STORE_SENTENCES_SUFFIX, columns=["sentence"])
+    sentences = sentence_table.column("sentence").to_pylist()
+    model_name = (sentence_table.schema.metadata or {}).get(EMBEDDING_STORE_MODEL_KEY, EMBEDDING_MODEL_NAME.encode("utf-8")).decode("utf-8")
+    embeddings = np.load(store_path + ".npy", mmap_mode="r")
+    if len(embeddings) != len(sentences):
+        return None
+    return {"sentences": sentences, "embeddings": embeddings, "model_name": model_name}
+
+def load_or_generate_embedding_store(store_path, sentences, legacy_pickle_path=None, model_name=EMBEDDING_MODEL_NAME, dtype=np.float32):
+    """
+    Opens the embedding store of exactly these sentences, model and dtype, creating it first if it doesn't exist or is for other ones
+    Args:
+        store_path: the path of the store without extension, see write_embedding_store
+        sentences: a list of strings
+        legacy_pickle_path: a pickled dataframe with 'sentence' and 'embedding' columns, from before embedding stores, embedded with EMBEDDING_MODEL_NAME; 
+                            if it has exactly these sentences, its embeddings get moved to the store instead of being computed again
+        model_name: the sentence transformer model to embed with, see get_sentence_embeddings
+        dtype: the dtype the matrix is stored as, np.float32 or np.float16
+    Returns:
+        The store, see read_embedding_store
+    """
+    sentences = list(sentences)
+    embedding_store = read_embedding_store(store_path)
+    if (embedding_store is not None and embedding_store["sentences"] == sentences 
+            and embedding_store["model_name"] == model_name and embedding_store["embeddings"].dtype == np.dtype(dtype)):
+        return embedding_store
+
+    if legacy_pickle_path is not None and exists(legacy_pickle_path) and model_name == EMBEDDING_MODEL_NAME:
+        legacy_embeddings = pd.read_pickle(legacy_pickle_path)
+        if legacy_embeddings['sentence'].tolist() == sentences:
+            print(f"moving the embeddings in {legacy_pickle_path} to {store_path}.npy...")
+            write_embedding_store(store_path, sentences, np.stack(legacy_embeddings['embedding'].values), dtype, model_name)
+            return read_embedding_store(store_path)
+
+    print(f"Calling get_sentence_embeddings for {store_path}")
+    write_embedding_store(store_path, sentences, get_sentence_embeddings(sentences, model_name, dtype=dtype), dtype, model_name)
+    return read_embedding_store(store_path)
@@ -0,0 +1,201 @@
+from os.path import exists, getsize, join
+import os
+import json
+import time
+import hashlib
+import pandas as pd
+import pyarrow.dataset
+import pyarrow.feather as feather
+from sqlite_store import open_sqlite_store, read_sqlite_store, write_sqlite_store
+
+
+FEATURE_CACHE_DIR = "feature_cache"
+FEATURE_CACHE_INDEX = "index.json"
+FEATURE_CACHE_MAX_SIZE = 2 * 1024 ** 3 # bytes; least recently used datasets get evicted past this
+# how cached datasets are written: "parquet" (compressed, smallest on disk), "arrow" (Arrow IPC, fastest memory-mapped reads) or "pickle"
+FEATURE_CACHE_FORMAT = "parquet"
+FEATURE_FRAME_EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow", "pickle": ".pkl"}
+FEATURE_STORE_FILENAME = "feature_rows.sqlite"
+
+
+def hash_sentence(sentence):
+    return hashlib.sha1(sentence.encode("utf-8")).hexdigest()
+
+def hash_sentences(sentences):
+    """
+    Returns:
+        A list with the hash (str) of every sentence, in the same order as the sentences
+    """
+    return [hash_sentence(sentence) for sentence in sentences]
+
+def hash_files(paths):
+    """
+    Hashes the contents of some files, e.g. the lexicons, so that editing or replacing any of them changes the hash
+    """
+    file_hash = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(block)
+        file_hash.update(b"\0")
+    return file_hash.hexdigest()
+
+def get_feature_fingerprint(lexicons_hash, columns, tokenizer_version=""):
+    """
+    Identifies everything other than the sentences that the features depend on: the lexicons, the feature columns and the version of the tokenizer.
+    Cached rows are only ever reused between datasets with the same fingerprint.
+    Args:
+        lexicons_hash: a hash (str) of the lexicons, e.g. hash_files of the lexicon files
+        columns: the feature columns
+        tokenizer_version: the version of the tokenizer the features were computed with
+    """
+    schema = list(columns) if tokenizer_version == "" else [list(columns), tokenizer_version]
+    schema_hash = hashlib.sha256(json.dumps(schema).encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{lexicons_hash}:{schema_hash}".encode("utf-8")).hexdigest()
+
+def get_dataset_key(sentence_hashes, labels, fingerprint):
+    """
+    Returns:
+        The content address (str) of a dataset: a hash of its sentences and labels, in order, and of its feature fingerprint
+    """
+    dataset_hash = hashlib.sha256(fingerprint.encode("utf-8"))
+    for sentence_hash, label in zip(sentence_hashes, labels):
+        dataset_hash.update(f"{label}:{sentence_hash}\n".encode("utf-8"))
+    return dataset_hash.hexdigest()
+
+def read_feature_cache_index(cache_dir=FEATURE_CACHE_DIR):
+    """
+    Returns:
+        A dictionary, where the keys (str) are dataset keys and values (dict) hold the "file", "size", "last_used",
+        "fingerprint" and "num_rows" of that cached dataset
+    """
+    index_path = join(cache_dir, FEATURE_CACHE_INDEX)
+    if not exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+def write_feature_cache_index(index, cache_dir=FEATURE_CACHE_DIR):
+    index_path = join(cache_dir, FEATURE_CACHE_INDEX)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path + ".tmp", index_path)
+
+def write_feature_frame(data, path):
+    """
+    Writes a dataframe in the format given by the extension of path: Parquet (zstd compressed), Arrow IPC (lz4 compressed) or pickle
+    """
+    if path.endswith(FEATURE_FRAME_EXTENSIONS["parquet"]):
+        data.to_parquet(path, compression="zstd")
+    elif path.endswith(FEATURE_FRAME_EXTENSIONS["arrow"]):
+        feather.write_feather(data, path, compression="lz4")
+    else:
+        data.to_pickle(path)
+
+def read_feature_frame(path, columns=None):
+    """
+    Reads a dataframe written by write_feature_frame. Parquet and Arrow IPC files are memory-mapped and only the requested columns get read.
+    Args:
+        path: the file to read
+        columns: a list of the columns to load, or None to load all of them
+    """
+    if path.endswith(FEATURE_FRAME_EXTENSIONS["parquet"]):
+        return pd.read_parquet(path, columns=columns, memory_map=True)
+    if path.endswith(FEATURE_FRAME_EXTENSIONS["arrow"]):
+        return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    data = pd.read_pickle(path)
+    return data if columns is None else data[columns]
+
+def open_feature_dataset(path):
+    """
+    Opens a Parquet feature dataset written a batch at a time (see utils.generate_feature_dataset) without reading any of it:
+    rows only get read when asked for, e.g. with to_batches or with to_table(columns=...) for a few columns
+    Returns:
+        A pyarrow dataset
+    """
+    return pyarrow.dataset.dataset(path, format="parquet")
+
+def read_cached_dataframe(key, cache_dir=FEATURE_CACHE_DIR, columns=None):
+    """
+    Looks a dataset up in the cache and marks it as recently used
+    Args:
+        key: the dataset key, from get_dataset_key
+        cache_dir: the directory of the feature cache
+        columns: a list of the columns to load, or None to load all of them
+    Returns:
+        The cached dataframe, or None if this dataset isn't in the cache
+    """
+    index = read_feature_cache_index(cache_dir)
+    if key not in index or not exists(join(cache_dir, index[key]["file"])):
+        return None
+    data = read_feature_frame(join(cache_dir, index[key]["file"]), columns)
+    index[key]["last_used"] = time.time()
+    write_feature_cache_index(index, cache_dir)
+    return data
+
+def write_cached_dataframe(key, data, fingerprint, cache_dir=FEATURE_CACHE_DIR, max_size=FEATURE_CACHE_MAX_SIZE, storage_format=FEATURE_CACHE_FORMAT):
+    """
+    Saves a dataset to the cache, then evicts the least recently used datasets until the cache fits in max_size bytes again
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = f"{key}{FEATURE_FRAME_EXTENSIONS[storage_format]}"
+    write_feature_frame(data, join(cache_dir, filename))
+
+    index = read_feature_cache_index(cache_dir)
+    if key in index and index[key]["file"] != filename and exists(join(cache_dir, index[key]["file"])):
+        os.remove(join(cache_dir, index[key]["file"]))
+    index[key] = {
+        "file": filename,
+        "size": getsize(join(cache_dir, filename)),
+        "last_used": time.time(),
+        "fingerprint": fingerprint,
+        "num_rows": len(data)
+    }
+
+    total_size = sum(entry["size"] for entry in index.values())
+    for old_key in sorted(index, key=lambda k: index[k]["last_used"]):
+        if total_size <= max_size:
+            break
+        if old_key == key:
+            continue
+        print(f"evicting {index[old_key]['file']} from the feature cache...")
+        total_size -= index[old_key]["size"]
+        if exists(join(cache_dir, index[old_key]["file"])):
+            os.remove(join(cache_dir, index[old_key]["file"]))
+        del index[old_key]
+
+    write_feature_cache_index(index, cache_dir)
+
+def open_feature_store(fingerprint, cache_dir=FEATURE_CACHE_DIR):
+    """
+    Opens the on-disk table of feature rows computed so far, keyed by feature fingerprint and sentence hash.
+    Every dataset built with the same lexicons and feature columns shares it, so a sentence's features only ever get computed once.
+    Args:
+        fingerprint: the feature fingerprint, from get_feature_fingerprint
+        cache_dir: the directory of the feature cache
+    Returns:
+        The sqlite store (see sqlite_store.open_sqlite_store) that rows are read and written under the fingerprint in
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    return open_sqlite_store(join(cache_dir, FEATURE_STORE_FILENAME), "feature_rows", "fingerprint", "feature_row", "TEXT", fingerprint)
+
+def read_feature_rows(feature_store, sentence_hashes):
+    """
+    Looks sentences up in the feature store
+    Args:
+        feature_store: the store returned by open_feature_store
+        sentence_hashes: an iterable of sentence hashes (str)
+    Returns:
+        A dictionary, where the keys (str) are the hashes of the sentences that were found and values (list) are their feature rows
+    """
+    return {sentence_hash: json.loads(feature_row) for sentence_hash, feature_row in read_sqlite_store(feature_store, sentence_hashes).items()}
+
+def write_feature_rows(feature_store, feature_rows):
+    """
+    Adds rows to the feature store
+    Args:
+        feature_store: the store returned by open_feature_store
+        feature_rows: a dictionary, where the keys (str) are sentence hashes and values (list) are their feature rows
+    """
+    # json writes floats with repr, which reads back as exactly the same float
+    write_sqlite_store(feature_store, {sentence_hash: json.dumps(list(feature_row)) for sentence_hash, feature_row in feature_rows.items()})
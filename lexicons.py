@@ -0,0 +1,476 @@
+from os.path import exists
+import os
+import csv
+import re
+import json
+import hashlib
+import itertools
+import tempfile
+import numpy as np
+from feature_cache import hash_files
+from tokenizer import build_phrase_index
+
+
+VAD_LEXICON_PATH = 'lexicons/NRC-VAD-Lexicon-Aug2018Release/OneFilePerDimension/{dimension}-scores.txt'
+CONCRETENESS_LEXICON_PATH = 'lexicons/concreteness.csv'
+LIWC_LEXICON_PATH = 'lexicons/LIWC2007_English080730.dic'
+# every lexicon file the features depend on, so that the feature cache can tell when one of them changes
+LEXICON_PATHS = [VAD_LEXICON_PATH.format(dimension=dimension) for dimension in ["v", "a", "d"]] + [CONCRETENESS_LEXICON_PATH, LIWC_LEXICON_PATH]
+# all the lexicons above compiled into one binary file, see compile_lexicons
+COMPILED_LEXICON_PATH = 'lexicons/compiled_lexicons.bin'
+COMPILED_LEXICON_MAGIC = b"LEXICON1"
+COMPILED_LEXICON_ALIGNMENT = 64 # bytes; every array starts at a multiple of this, so that it can be viewed in place
+VAD_DIMENSIONS = ["v", "a", "d"]
+# the names get_lexicon knows the VAD dimensions by
+VAD_DIMENSION_NAMES = {"sentiment": "v", "agency": "a", "power": "d"}
+# the score lexicons get_lexicon("merged") merges, in the order of their columns in a feature vector
+MERGED_LEXICON_NAMES = ["power", "agency", "sentiment", "concreteness"]
+# every lexicon loaded so far by this process, keyed by name; see get_lexicon
+lexicon_registry = {}
+# the memory-mapped compiled lexicons of this process, keyed by path; see read_compiled_lexicons
+compiled_lexicons_by_path = {}
+# the merged lexicons of this process, keyed by the ids of the lexicons they were merged from; see get_merged_lexicon
+merged_lexicons_by_ids = {}
+# the phrase indexes of the lexicons of this process, keyed by the id of their lexicon; see get_phrase_index
+phrase_indexes_by_ids = {}
+LIWC_TOKEN_CACHE_MAX_SIZE = 200000 # tokens; the memo of a compiled LIWC matcher starts over once it's this big, see get_LIWC_token_categories
+# key under which a node of the compiled LIWC prefix trie stores its categories; not a character, so it can't collide with one
+LIWC_TRIE_CATEGORIES = None
+
+
+def parse_VAD_scores(dimension_to_load):
+    """
+    Parses dominance (aka power) from the text file of the VAD lexicon. 
+    Args:
+        dimension_to_load: a string with just 3 options to specify which dimension to load: 
+                           "v" (valence / sentiment), "a" (arousal / agency), "d" (dominance / power)
+    Returns:
+        A dictionary, where keys (str) are the words in the lexicon and values (float) are their power score
+    """
+    assert dimension_to_load == "v" or dimension_to_load == "a" or dimension_to_load == "d"
+    power_scores = {}
+    with open(VAD_LEXICON_PATH.format(dimension=dimension_to_load)) as f:
+        lines = f.readlines()
+        for line in lines:
+            line = line.strip()
+            word, score = line.split("\t")
+            power_scores[word] = float(score)
+            # print(f"power_scores[{word}] = {float(score)}")
+    return power_scores
+
+def parse_concreteness():
+    """
+    Parses concreteness scores from the CSV file of the concreteness lexicon.
+    Returns: 
+        A dictionary, where the keys (str) are the words in the lexicon and values (float) are their power score.
+        The bigrams of the lexicon (e.g. "give up") are keys like any other word; the scorers match them in sentences with a phrase index (see get_phrase_index)
+    """
+    concreteness_scores = {}
+    with open(CONCRETENESS_LEXICON_PATH, newline='') as csvfile:
+        csv_reader = csv.reader(csvfile)
+        next(csv_reader)
+        for row in csv_reader:
+            # print(row)
+            token = row[0]
+            concreteness_mean_score = float(row[2])
+            concreteness_scores[token] = concreteness_mean_score
+    return concreteness_scores
+
+def parse_LIWC_lexicon():
+    """
+    Parses the .dic file of the LIWC lexicon.
+    Returns:
+        A dictionary, where the keys (str) are the names of categories, and values (list) are lists of words / word prefixes (str) that fall under that category.
+    """
+    liwc_words_by_category = {}
+    category_num_to_name = {}
+
+    with open(LIWC_LEXICON_PATH) as f:
+        lines = f.readlines()
+        words_start_at = None
+
+        # read the categories first
+        for index in range(1, len(lines)):
+            line = lines[index]
+            line = line.strip()
+            if line == "%":
+                words_start_at = index + 1
+                break
+            number, category = line.split("\t")
+            # print(f"category: {category}, number: {number}")
+            liwc_words_by_category[category] = []
+            category_num_to_name[int(number)] = category
+
+        # then read the lines with words followed by category numbers
+        for line in lines[words_start_at:]:
+            line = line.strip()
+            line = re.sub("<.*?>|[()/ ]", "\t", line)
+            elements = line.split("\t")
+            word = elements[0]
+            categories = elements[1:]
+            for category_number in categories:
+                if category_number == "":
+                    continue
+                category_name = category_num_to_name[int(category_number)]
+                liwc_words_by_category[category_name].append(word)
+
+    return liwc_words_by_category
+
+def encode_string_table(strings):
+    """
+    Returns:
+        A numpy array of bytes with the strings encoded as utf-8 and separated by newlines
+    """
+    return np.frombuffer("\n".join(strings).encode("utf-8"), dtype=np.uint8)
+
+def decode_string_table(string_table):
+    if len(string_table) == 0:
+        return []
+    return string_table.tobytes().decode("utf-8").split("\n")
+
+def compile_lexicons(out_path=COMPILED_LEXICON_PATH):
+    """
+    Parses the VAD, concreteness and LIWC lexicons once and writes them into a single binary file that read_compiled_lexicons
+    memory-maps, so that scripts don't have to parse the text files every time they start.
+    The file holds a magic string, the length of a JSON header, the header, then these arrays, each aligned to COMPILED_LEXICON_ALIGNMENT bytes:
+        vad_words: the sorted words of the VAD lexicon, as a string table (see encode_string_table)
+        vad_scores: a float64 array of shape (len(vad_words), 3) with the v, a and d score of every word, NaN where a dimension has no score
+        concreteness_words, concreteness_scores: same for the concreteness lexicon
+        liwc_categories: the names of the LIWC categories, in the order of the .dic file, as a string table
+        liwc_words: the sorted LIWC words / word prefixes, as a string table
+        liwc_bitsets: a uint8 array of shape (len(liwc_words), ceil(len(liwc_categories) / 8)) with the categories of every word as packed bits
+    Scores are kept as float64, so they are exactly the floats parsed from the text files.
+    """
+    vad_scores_by_dimension = [parse_VAD_scores(dimension) for dimension in VAD_DIMENSIONS]
+    vad_words = sorted(set().union(*vad_scores_by_dimension))
+    vad_scores = np.array(
+        [[scores.get(word, np.nan) for scores in vad_scores_by_dimension] for word in vad_words], 
+        dtype=np.float64).reshape(len(vad_words), len(VAD_DIMENSIONS))
+
+    concreteness = parse_concreteness()
+    concreteness_words = sorted(concreteness)
+    concreteness_scores = np.array([concreteness[word] for word in concreteness_words], dtype=np.float64)
+
+    liwc_words_by_category = parse_LIWC_lexicon()
+    liwc_categories = list(liwc_words_by_category.keys())
+    liwc_words = sorted(set(itertools.chain.from_iterable(liwc_words_by_category.values())))
+    liwc_word_index = {word: index for index, word in enumerate(liwc_words)}
+    liwc_membership = np.zeros((len(liwc_words), len(liwc_categories)), dtype=bool)
+    for category_index, category in enumerate(liwc_categories):
+        for word in liwc_words_by_category[category]:
+            liwc_membership[liwc_word_index[word], category_index] = True
+
+    arrays = {
+        "vad_words": encode_string_table(vad_words),
+        "vad_scores": vad_scores,
+        "concreteness_words": encode_string_table(concreteness_words),
+        "concreteness_scores": concreteness_scores,
+        "liwc_categories": encode_string_table(liwc_categories),
+        "liwc_words": encode_string_table(liwc_words),
+        "liwc_bitsets": np.packbits(liwc_membership, axis=1)
+    }
+
+    header = {"sources": hash_files(LEXICON_PATHS), "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // COMPILED_LEXICON_ALIGNMENT) * COMPILED_LEXICON_ALIGNMENT
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = -(-(len(COMPILED_LEXICON_MAGIC) + 8 + len(header_bytes)) // COMPILED_LEXICON_ALIGNMENT) * COMPILED_LEXICON_ALIGNMENT
+
+    print(f"compiling lexicons to {out_path}...")
+    # every compile gets its own temporary file, so that processes compiling at the same time never write into each other's file,
+    # and whichever one replaces out_path last, it's a complete file
+    temporary_fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(out_path) or ".", prefix=os.path.basename(out_path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(temporary_fd, "wb") as f:
+            f.write(COMPILED_LEXICON_MAGIC)
+            f.write(len(header_bytes).to_bytes(8, "little"))
+            f.write(header_bytes)
+            for name, array in arrays.items():
+                f.seek(data_start + header["arrays"][name]["offset"])
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(temporary_path, out_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+def read_compiled_lexicons(path=COMPILED_LEXICON_PATH):
+    """
+    Memory-maps the file written by compile_lexicons, compiling it first if it doesn't exist yet or if any of the lexicon files changed since.
+    The arrays are read-only views into the mapped file. The read_* functions below decode them into plain dictionaries (and read_LIWC_lexicon rebuilds the prefix trie),
+    which is what scoring looks tokens up in, so every process still holds its own copy of the lexicons; the file only saves parsing the text files.
+    The file only gets mapped once per process.
+    Returns:
+        A dictionary, where the keys (str) are the array names listed in compile_lexicons and values are numpy arrays
+    """
+    if path in compiled_lexicons_by_path:
+        return compiled_lexicons_by_path[path]
+
+    if not exists(path) or (all(exists(source) for source in LEXICON_PATHS) and read_compiled_lexicons_header(path)["sources"] != hash_files(LEXICON_PATHS)):
+        compile_lexicons(path)
+
+    header = read_compiled_lexicons_header(path)
+    mapped_file = np.memmap(path, dtype=np.uint8, mode="r")
+    header_length = int.from_bytes(mapped_file[len(COMPILED_LEXICON_MAGIC):len(COMPILED_LEXICON_MAGIC) + 8].tobytes(), "little")
+    data_start = -(-(len(COMPILED_LEXICON_MAGIC) + 8 + header_length) // COMPILED_LEXICON_ALIGNMENT) * COMPILED_LEXICON_ALIGNMENT
+
+    arrays = {}
+    for name, layout in header["arrays"].items():
+        dtype = np.dtype(layout["dtype"])
+        start = data_start + layout["offset"]
+        count = int(np.prod(layout["shape"]))
+        arrays[name] = mapped_file[start:start + count * dtype.itemsize].view(dtype).reshape(layout["shape"])
+    compiled_lexicons_by_path[path] = arrays
+    return arrays
+
+def read_compiled_lexicons_header(path=COMPILED_LEXICON_PATH):
+    with open(path, "rb") as f:
+        magic = f.read(len(COMPILED_LEXICON_MAGIC))
+        assert magic == COMPILED_LEXICON_MAGIC, f"{path} is not a compiled lexicon file"
+        header_length = int.from_bytes(f.read(8), "little")
+        return json.loads(f.read(header_length))
+
+def get_compiled_lexicons_sources(path=COMPILED_LEXICON_PATH):
+    """
+    Returns:
+        The hash (str) of the lexicon files the compiled lexicons were compiled from (see hash_files), compiling them first like read_compiled_lexicons does.
+        It's the hash of the lexicons get_lexicon loads, even when only the compiled file is there
+    """
+    read_compiled_lexicons(path)
+    return read_compiled_lexicons_header(path)["sources"]
+
+def get_lexicon_hash(lexicon):
+    """
+    Hashes the contents of a lexicon object, e.g. a custom lexicon passed in place of a registry one, so that features computed with it can be told apart
+    Args:
+        lexicon: a dictionary of scores, a dictionary of LIWC word lists or a compiled LIWC matcher (see compile_LIWC_lexicon)
+    Returns:
+        A hash (str) that changes whenever any word, score or category of the lexicon does
+    """
+    if is_compiled_LIWC_lexicon(lexicon):
+        # the token cache is left out, it only memoizes lookups
+        contents = [lexicon["categories"], sorted(lexicon["exact"].items()), sorted(get_LIWC_trie_prefixes(lexicon["prefixes"]))]
+    else:
+        contents = list(lexicon.items())
+    return hashlib.sha256(json.dumps(contents).encode("utf-8")).hexdigest()
+
+def get_LIWC_trie_prefixes(prefixes):
+    """
+    Returns:
+        A list with a (prefix, categories) tuple for every node of a compiled LIWC prefix trie that holds categories
+    """
+    prefix_categories = []
+    nodes = [("", prefixes)]
+    while len(nodes) > 0:
+        prefix, node = nodes.pop()
+        for char, child in node.items():
+            if char is LIWC_TRIE_CATEGORIES:
+                prefix_categories.append((prefix, list(child)))
+            else:
+                nodes.append((prefix + char, child))
+    return prefix_categories
+
+def read_VAD_scores(dimension_to_load):
+    """
+    Reads dominance (aka power) from the VAD lexicon. 
+    Args:
+        dimension_to_load: a string with just 3 options to specify which dimension to load: 
+                           "v" (valence / sentiment), "a" (arousal / agency), "d" (dominance / power)
+    Returns:
+        A dictionary, where keys (str) are the words in the lexicon and values (float) are their power score
+    """
+    assert dimension_to_load == "v" or dimension_to_load == "a" or dimension_to_load == "d"
+    compiled_lexicons = read_compiled_lexicons()
+    vad_words = decode_string_table(compiled_lexicons["vad_words"])
+    scores = compiled_lexicons["vad_scores"][:, VAD_DIMENSIONS.index(dimension_to_load)]
+    has_score = ~np.isnan(scores)
+    return dict(zip(itertools.compress(vad_words, has_score), scores[has_score].tolist()))
+
+def read_all_VAD_scores():
+    """
+    Reads all three dimensions of the VAD lexicon in one pass over the compiled lexicons, decoding the word table only once
+    Returns:
+        A dictionary, where the keys (str) are the dimensions "v", "a" and "d" and values are dictionaries like the ones read_VAD_scores returns
+    """
+    compiled_lexicons = read_compiled_lexicons()
+    vad_words = decode_string_table(compiled_lexicons["vad_words"])
+    vad_scores = {}
+    for dimension_index, dimension in enumerate(VAD_DIMENSIONS):
+        scores = compiled_lexicons["vad_scores"][:, dimension_index]
+        has_score = ~np.isnan(scores)
+        vad_scores[dimension] = dict(zip(itertools.compress(vad_words, has_score), scores[has_score].tolist()))
+    return vad_scores
+
+def read_concreteness():
+    """
+    Reads concreteness scores from the concreteness lexicon.
+    Returns: 
+        A dictionary, where the keys (str) are the words in the lexicon and values (float) are their power score
+    """
+    compiled_lexicons = read_compiled_lexicons()
+    concreteness_words = decode_string_table(compiled_lexicons["concreteness_words"])
+    return dict(zip(concreteness_words, compiled_lexicons["concreteness_scores"].tolist()))
+
+def read_LIWC_lexicon(compiled=False):
+    """
+    Reads the LIWC lexicon.
+    Args:
+        compiled: if True, returns the compiled matcher from compile_LIWC_lexicon instead of the raw word lists
+    Returns:
+        A dictionary, where the keys (str) are the names of categories, and values (list) are lists of words / word prefixes (str) that fall under that category.
+    """
+    compiled_lexicons = read_compiled_lexicons()
+    liwc_categories = decode_string_table(compiled_lexicons["liwc_categories"])
+    liwc_words = decode_string_table(compiled_lexicons["liwc_words"])
+    liwc_membership = np.unpackbits(compiled_lexicons["liwc_bitsets"], axis=1, count=len(liwc_categories)).astype(bool)
+
+    liwc_words_by_category = {}
+    for category_index, category in enumerate(liwc_categories):
+        liwc_words_by_category[category] = list(itertools.compress(liwc_words, liwc_membership[:, category_index]))
+
+    if compiled:
+        return compile_LIWC_lexicon(liwc_words_by_category)
+    return liwc_words_by_category
+
+def get_lexicon(name):
+    """
+    Returns a lexicon from the process-wide registry, loading it on first access and keeping it for the life of the process, 
+    so every caller shares one copy and lexicons nobody asks for are never loaded. 
+    The first access to any VAD dimension loads all three of them at once, with read_all_VAD_scores.
+    Args:
+        name: "power", "agency" or "sentiment" for a VAD dimension, "concreteness", "liwc" for the compiled LIWC matcher,
+              or "merged" for all the MERGED_LEXICON_NAMES merged into one (see merge_lexicons)
+    Returns:
+        The same dictionary the corresponding read_* function returns, or the one merge_lexicons returns
+    """
+    assert name in VAD_DIMENSION_NAMES or name == "concreteness" or name == "liwc" or name == "merged"
+    if name not in lexicon_registry:
+        if name == "merged":
+            lexicon_registry[name] = get_merged_lexicon([get_lexicon(lexicon_name) for lexicon_name in MERGED_LEXICON_NAMES])
+        elif name in VAD_DIMENSION_NAMES:
+            vad_scores = read_all_VAD_scores()
+            for dimension_name, dimension in VAD_DIMENSION_NAMES.items():
+                lexicon_registry[dimension_name] = vad_scores[dimension]
+        elif name == "concreteness":
+            lexicon_registry[name] = read_concreteness()
+        else:
+            lexicon_registry[name] = read_LIWC_lexicon(compiled=True)
+    return lexicon_registry[name]
+
+def merge_lexicons(lexicons):
+    """
+    Merges score lexicons into one, so that a single lookup per token finds its scores in all of them at once
+    Args:
+        lexicons: a list of dictionaries, where keys (str) are the words in a lexicon and values (float) are their score
+    Returns:
+        A dictionary, where the keys (str) are the words in any of the lexicons and values are tuples (scores, mask):
+            scores: a tuple with the score (float) of the word in every lexicon, in the order of lexicons, and 0.0 for the lexicons it isn't in
+            mask: a tuple with 1 for every lexicon the word is in, and 0 for the others
+    """
+    scores_by_word = {}
+    masks_by_word = {}
+    for lexicon_index, lexicon in enumerate(lexicons):
+        for word, score in lexicon.items():
+            if word not in scores_by_word:
+                scores_by_word[word] = [0.0] * len(lexicons)
+                masks_by_word[word] = [0] * len(lexicons)
+            scores_by_word[word][lexicon_index] = score
+            masks_by_word[word][lexicon_index] = 1
+    return {word: (tuple(scores), tuple(masks_by_word[word])) for word, scores in scores_by_word.items()}
+
+def get_merged_lexicon(lexicons):
+    """
+    The memoized version of merge_lexicons, so that the same lexicons only get merged once per process, however many sentences get scored with them.
+    Lexicons are told apart by identity, so a lexicon shouldn't be changed once it was merged
+    """
+    key = tuple(id(lexicon) for lexicon in lexicons)
+    if key not in merged_lexicons_by_ids:
+        # the lexicons are kept along with their merge, so that their ids can't get reused by other objects
+        merged_lexicons_by_ids[key] = (list(lexicons), merge_lexicons(lexicons))
+    return merged_lexicons_by_ids[key][1]
+
+def get_phrase_index(lexicon):
+    """
+    Returns the phrase index of the multi-word entries of a lexicon (see tokenizer.build_phrase_index), building it the first time it's asked for. 
+    Like get_merged_lexicon, lexicons are told apart by identity, so a lexicon shouldn't be changed once it was indexed
+    """
+    key = id(lexicon)
+    if key not in phrase_indexes_by_ids:
+        # the lexicon is kept along with its index, so that its id can't get reused by another object
+        phrase_indexes_by_ids[key] = (lexicon, build_phrase_index(lexicon))
+    return phrase_indexes_by_ids[key][1]
+
+def compile_LIWC_lexicon(liwc_words_by_category):
+    """
+    Compiles the LIWC word lists into a matcher that finds all the categories of a token with a single lookup, 
+    instead of scanning every word of every category.
+    Args:
+        liwc_words_by_category: A dictionary, where the keys (str) are the names of categories, and values (list) are lists of words / word prefixes (str) that fall under that category
+    Returns:
+        A dictionary with the keys:
+            "categories": a list of all the category names (str)
+            "exact": a dictionary mapping each regular word (str) to a tuple of the categories (str) it falls under
+            "prefixes": a trie of the word prefixes (the entries ending in '*'), as nested dictionaries keyed by character; 
+                        a node has a LIWC_TRIE_CATEGORIES entry holding the categories of the prefix that ends there
+            "token_cache": a dictionary memoizing the categories (tuple) of every token looked up so far
+    """
+    exact = {}
+    prefixes = {}
+    for category, words_in_category in liwc_words_by_category.items():
+        for word_in_category in words_in_category:
+            if word_in_category.endswith('*'):
+                node = prefixes
+                for char in word_in_category[:-1]:
+                    node = node.setdefault(char, {})
+                node.setdefault(LIWC_TRIE_CATEGORIES, [])
+                if category not in node[LIWC_TRIE_CATEGORIES]:
+                    node[LIWC_TRIE_CATEGORIES].append(category)
+            else:
+                exact.setdefault(word_in_category, [])
+                if category not in exact[word_in_category]:
+                    exact[word_in_category].append(category)
+
+    return {
+        "categories": list(liwc_words_by_category.keys()),
+        "exact": {word: tuple(categories) for word, categories in exact.items()},
+        "prefixes": prefixes,
+        "token_cache": {}
+    }
+
+def is_compiled_LIWC_lexicon(liwc_lexicon):
+    return "prefixes" in liwc_lexicon and "token_cache" in liwc_lexicon
+
+def get_LIWC_token_categories(token, liwc_matcher):
+    """
+    Looks up a single token in the compiled LIWC matcher. Like LIWC itself, an exact entry wins over word prefixes, 
+    and otherwise the longest matching prefix is used.
+    Args:
+        token: a string
+        liwc_matcher: the compiled matcher returned by compile_LIWC_lexicon
+    Returns:
+        A tuple of the categories (str) the token falls under; empty if it isn't in the lexicon
+    """
+    token_cache = liwc_matcher["token_cache"]
+    if token in token_cache:
+        return token_cache[token]
+
+    categories = liwc_matcher["exact"].get(token)
+    if categories is None:
+        categories = ()
+        node = liwc_matcher["prefixes"]
+        for char in token:
+            node = node.get(char)
+            if node is None:
+                break
+            if LIWC_TRIE_CATEGORIES in node:
+                categories = tuple(node[LIWC_TRIE_CATEGORIES])
+
+    if len(token_cache) >= LIWC_TOKEN_CACHE_MAX_SIZE:
+        token_cache.clear()
+    token_cache[token] = categories
+    return categories
+
+
+if __name__ == "__main__":
+    compile_lexicons()
@@ -3,10 +3,7 @@ from utils import (
     read_talkdown, 
     read_filtered_reddit, 
     read_filtered_reddit_with_metadata,
-    read_VAD_scores, 
-    read_concreteness, 
     get_sentence_lexicon_score, 
-    read_LIWC_lexicon, 
     get_LIWC_count,
     load_or_generate_dataframe,
     save_descriptive_stats,
@@ -20,6 +17,7 @@ from utils import (
 import statsmodels.formula.api as smf
 import statsmodels.stats.weightstats as stattests
 import pandas as pd
+import os
 
 
 def get_feature_vector(sentence, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category):
@@ -69,23 +67,15 @@ if __name__ == "__main__":
     talkup_full_with_metadata = read_filtered_reddit_with_metadata()
     talkup_highest_scores = get_talkup_highest_scores(talkup_full_with_metadata, len(talkdown))
 
-    ### Load VAD lexicon
-    sentiment_scores = read_VAD_scores("v") # v for valence
-    agency_scores = read_VAD_scores("a") # a for agency
-    power_scores = read_VAD_scores("d") # d for dominance
-
-    ### Load concreteness lexicon
-    concreteness_scores = read_concreteness()
-
-    ### Load LIWC
-    liwc_words_by_category = read_LIWC_lexicon()
+    ### The VAD, concreteness and LIWC lexicons get loaded from the lexicon registry (see lexicons.get_lexicon),
+    ### only if some of the sentences below aren't in the feature store yet
 
     # ### Feature extraction
     # X = [] # a list of lists, where rows are samples and columns are features
     # y = [] # a list of 0's and 1's corresponding to the label of each sample. 0 = condescension, 1 = empowerment
 
-    data = load_or_generate_dataframe(talkdown, talkup_full, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category)
-    data_abridged = load_or_generate_dataframe(talkdown, talkup_highest_power, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category, abridged=True)
+    data = load_or_generate_dataframe(talkdown, talkup_full, num_workers=os.cpu_count())
+    data_abridged = load_or_generate_dataframe(talkdown, talkup_highest_power)
 
     # save_descriptive_stats(data, 'descriptive_stats/unabridged.csv')
     # save_descriptive_stats(data_abridged, 'descriptive_stats/abridged.csv')
@@ -139,23 +129,26 @@ if __name__ == "__main__":
     # lr_model_5 = smf.logit("is_empowering ~ power + agency + sentiment + concreteness + anger_count + social_count + relig_count + sexual_count + humans_count", data=data).fit()
     # models['VAD, CONCRETENESS, AND LIWC COUNTS, NO INTERACTIONS, FULL DATA'] = lr_model_5
 
+    # the columns that the logit formulas below use, so that cached datasets only load those
+    model_columns = ['is_empowering', 'power', 'agency', 'sentiment', 'concreteness', "anger_count", "social_count", "relig_count", "sexual_count", "humans_count"]
+
     # Best performing model so far -- now we want to try different ways of trimming the empowering set to 2600 examples
-    data_highest_power = load_or_generate_dataframe(talkdown, talkup_highest_power, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category, abridged=True)
+    data_highest_power = load_or_generate_dataframe(talkdown, talkup_highest_power, columns=model_columns)
     lr_model_6 = smf.logit("is_empowering ~ power + agency + sentiment + concreteness + anger_count + social_count + relig_count + sexual_count + humans_count", data=data_abridged).fit()
     models['VAD, CONCRETENESS, AND LIWC COUNTS, NO INTERACTIONS, HIGHEST POWER DATA'] = lr_model_6
 
     # Trying with embedding-matched data
-    data_matched = load_or_generate_dataframe(talkdown, talkup_matched, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category, matched=True)
+    data_matched = load_or_generate_dataframe(talkdown, talkup_matched, columns=model_columns)
     lr_model_7 = smf.logit("is_empowering ~ power + agency + sentiment + concreteness + anger_count + social_count + relig_count + sexual_count + humans_count", data=data_matched).fit()
     models['VAD, CONCRETENESS, AND LIWC COUNTS, NO INTERACTIONS, EMBEDDING-MATCHED DATA'] = lr_model_7
 
     # Trying with randomly sampled data
-    data_random = load_or_generate_dataframe(talkdown, talkup_random, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category)
+    data_random = load_or_generate_dataframe(talkdown, talkup_random, columns=model_columns)
     lr_model_8 = smf.logit("is_empowering ~ power + agency + sentiment + concreteness + anger_count + social_count + relig_count + sexual_count + humans_count", data=data_random).fit()
     models['VAD, CONCRETENESS, AND LIWC COUNTS, NO INTERACTIONS, RANDOM DATA'] = lr_model_8
 
     # Trying with posts with highest score
-    data_highest_score = load_or_generate_dataframe(talkdown, talkup_highest_scores, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category)
+    data_highest_score = load_or_generate_dataframe(talkdown, talkup_highest_scores, columns=model_columns)
     lr_model_9 = smf.logit("is_empowering ~ power + agency + sentiment + concreteness + anger_count + social_count + relig_count + sexual_count + humans_count", data=data_highest_score).fit()
     models['VAD, CONCRETENESS, AND LIWC COUNTS, NO INTERACTIONS, HIGHEST SCORE DATA'] = lr_model_9
 
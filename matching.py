@@ -0,0 +1,484 @@
+from os.path import exists
+import os
+import csv
+import json
+import time
+import hashlib
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+
+# the similarity matrix of one block is at most MATCHING_QUERY_BLOCK_SIZE x MATCHING_CANDIDATE_BLOCK_SIZE float32s (256 MB by default),
+# no matter how many queries and candidates there are
+MATCHING_QUERY_BLOCK_SIZE = 1024
+MATCHING_CANDIDATE_BLOCK_SIZE = 65536
+# queries per chunk of a resumable matching run; every finished chunk gets appended to the checkpoint file
+MATCHING_CHECKPOINT_CHUNK_SIZE = 256
+MATCHING_CHECKPOINT_COLUMNS = ["query_index", "candidate_index", "similarity", "num_candidates"]
+# a matching checkpoint or result file is saved along with a file identifying the queries, candidates and search it is for, see get_matching_source
+MATCHING_SOURCE_SUFFIX = ".source.json"
+# the numbers of IVF probes get_ivf_recall_report measures by default
+IVF_RECALL_NUM_PROBES = (1, 2, 4, 8, 16, 32, 64)
+
+
+def normalize_embeddings(embeddings):
+    """
+    L2-normalizes every row of an embedding matrix, so that dot products between rows are cosine similarities
+    Args:
+        embeddings: a numpy matrix with one embedding per row
+    Returns:
+        A float32 numpy matrix of the same shape; rows that are all zeros stay all zeros
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms > 0)
+
+def get_candidate_block(candidate_embeddings, start, end, normalized):
+    """
+    Returns:
+        Rows start to end of the candidates, as a float32 matrix that is L2-normalized (see normalize_embeddings)
+    """
+    candidate_block = candidate_embeddings[start:end]
+    if normalized:
+        return np.asarray(candidate_block, dtype=np.float32)
+    return normalize_embeddings(candidate_block)
+
+def get_most_similar_indices(query_embeddings, candidate_embeddings, query_block_size=MATCHING_QUERY_BLOCK_SIZE, candidate_block_size=MATCHING_CANDIDATE_BLOCK_SIZE, normalized=False):
+    """
+    Finds the most cosine-similar candidate for every query, with one matrix multiplication per block of queries and candidates
+    Args:
+        query_embeddings: a numpy matrix with one query embedding per row
+        candidate_embeddings: a numpy matrix with one candidate embedding per row
+        query_block_size, candidate_block_size: the number of queries / candidates per block, which bounds the memory used
+        normalized: whether the embeddings are already L2-normalized (see normalize_embeddings). If not, the queries get normalized up front 
+                    and the candidates block by block, so a memory-mapped candidate matrix never gets copied whole
+    Returns:
+        A tuple (best_indices, best_similarities) of numpy arrays with one entry per query: the row of its most similar candidate
+        (the first one, if several are tied) and their cosine similarity. With no candidates, the indices are -1 and the similarities -inf.
+    """
+    if not normalized:
+        query_embeddings = normalize_embeddings(query_embeddings)
+
+    best_indices = np.full(len(query_embeddings), -1, dtype=np.int64)
+    best_similarities = np.full(len(query_embeddings), -np.inf, dtype=np.float32)
+    for query_start in range(0, len(query_embeddings), query_block_size):
+        query_block = query_embeddings[query_start:query_start + query_block_size]
+        block_best_indices = best_indices[query_start:query_start + query_block_size]
+        block_best_similarities = best_similarities[query_start:query_start + query_block_size]
+
+        for candidate_start in range(0, len(candidate_embeddings), candidate_block_size):
+            candidate_block = get_candidate_block(candidate_embeddings, candidate_start, candidate_start + candidate_block_size, normalized)
+            similarities = query_block @ candidate_block.T
+            block_argmax = np.argmax(similarities, axis=1)
+            block_max = similarities[np.arange(len(query_block)), block_argmax]
+            # strictly greater, so that ties keep the earliest candidate
+            improved = block_max > block_best_similarities
+            block_best_indices[improved] = block_argmax[improved] + candidate_start
+            block_best_similarities[improved] = block_max[improved]
+
+    return best_indices, best_similarities
+
+def read_matching_checkpoint(checkpoint_path):
+    """
+    Reads the checkpoint file of a resumable matching run (see get_most_similar_indices_resumable)
+    Returns:
+        A dictionary, where the keys (int) are query indices and values are tuples (candidate_index, similarity, num_candidates) 
+        with the best match found for that query among the first num_candidates candidates. When a query appears several times, the last row wins.
+    """
+    checkpoint = {}
+    if not exists(checkpoint_path):
+        return checkpoint
+    with open(checkpoint_path, newline="") as f:
+        for row in csv.DictReader(f):
+            checkpoint[int(row["query_index"])] = (int(row["candidate_index"]), float(row["similarity"]), int(row["num_candidates"]))
+    return checkpoint
+
+def append_matching_checkpoint(checkpoint_path, query_indices, candidate_indices, similarities, num_candidates):
+    """
+    Appends the matches of a finished chunk of queries to the checkpoint file, and flushes them to disk before returning
+    """
+    write_header = not exists(checkpoint_path)
+    with open(checkpoint_path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(MATCHING_CHECKPOINT_COLUMNS)
+        for query_index, candidate_index, similarity in zip(query_indices, candidate_indices, similarities):
+            # repr keeps every digit of the float32 similarity, so a resumed run compares against exactly the same score
+            writer.writerow([int(query_index), int(candidate_index), repr(float(similarity)), num_candidates])
+        f.flush()
+        os.fsync(f.fileno())
+
+def get_keys_digest(keys):
+    return hashlib.sha256("\n".join(keys).encode("utf-8")).hexdigest()
+
+def get_matching_source(query_keys, candidate_keys, mode):
+    """
+    Identifies what a matching checkpoint or result file was computed from
+    Args:
+        query_keys: a list with a key (str) for every query, in order, e.g. the hashes of the sentences the query embeddings are for
+        candidate_keys: same for the candidates
+        mode: the search (str), e.g. "exact", or "ivf:16" for an IVF search with 16 probes
+    Returns:
+        A dictionary with the "mode", and the number and a digest of the "queries" and the "candidates"
+    """
+    return {
+        "mode": mode,
+        "num_queries": len(query_keys),
+        "queries": get_keys_digest(query_keys),
+        "num_candidates": len(candidate_keys),
+        "candidates": get_keys_digest(candidate_keys)
+    }
+
+def read_matching_source(path):
+    """
+    Returns:
+        The source saved along with the file at path by write_matching_source, or None if there is none
+    """
+    if not exists(path + MATCHING_SOURCE_SUFFIX):
+        return None
+    with open(path + MATCHING_SOURCE_SUFFIX) as f:
+        return json.load(f)
+
+def write_matching_source(path, source):
+    with open(path + MATCHING_SOURCE_SUFFIX + ".tmp", "w") as f:
+        json.dump(source, f)
+    os.replace(path + MATCHING_SOURCE_SUFFIX + ".tmp", path + MATCHING_SOURCE_SUFFIX)
+
+def is_matching_source_prefix(source, query_keys, candidate_keys, mode):
+    """
+    Returns:
+        True if source (see get_matching_source) is for the same search, over queries and candidates that the given ones only appended to
+    """
+    return (
+        source is not None
+        and source["mode"] == mode
+        and source["num_queries"] <= len(query_keys)
+        and source["num_candidates"] <= len(candidate_keys)
+        and get_keys_digest(query_keys[:source["num_queries"]]) == source["queries"]
+        and get_keys_digest(candidate_keys[:source["num_candidates"]]) == source["candidates"])
+
+def get_most_similar_indices_resumable(query_embeddings, candidate_embeddings, checkpoint_path, chunk_size=MATCHING_CHECKPOINT_CHUNK_SIZE, ivf_index=None, num_probes=16, normalized=False, query_keys=None, candidate_keys=None):
+    """
+    Does the same as get_most_similar_indices (or search_ivf_index, if an index is given), but chunk by chunk of queries, 
+    appending the matches of every finished chunk to a checkpoint file. Running it again with the same checkpoint resumes after the last finished chunk.
+    Queries and candidates may only grow by appending to the end: new queries get matched from scratch, 
+    and queries matched before the candidates grew only get compared with the new candidates, against their stored best score.
+    Args:
+        query_embeddings: a numpy matrix with one query embedding per row
+        candidate_embeddings: a numpy matrix with one candidate embedding per row
+        checkpoint_path: the checkpoint file, a CSV with the MATCHING_CHECKPOINT_COLUMNS
+        chunk_size: the number of queries per chunk
+        ivf_index: an optional index from build_ivf_index over these candidates, to search approximately
+        num_probes: the number of clusters to search per query when an ivf_index is given
+        normalized: whether the embeddings are already L2-normalized, see get_most_similar_indices
+        query_keys, candidate_keys: lists with a key (str) for every query and candidate, e.g. the hashes of their sentences (see get_matching_source).
+            When given, the checkpoint only gets resumed if it was written by the same search over queries and candidates that these only appended to,
+            and it starts over otherwise, since the indices it holds would point at other sentences
+    Returns:
+        A tuple (best_indices, best_similarities), like get_most_similar_indices
+    """
+    if query_keys is not None:
+        mode = "exact" if ivf_index is None else f"ivf:{num_probes}"
+        if exists(checkpoint_path) and not is_matching_source_prefix(read_matching_source(checkpoint_path), query_keys, candidate_keys, mode):
+            print(f"{checkpoint_path} was written for other queries, candidates or search, starting over...")
+            os.remove(checkpoint_path)
+        write_matching_source(checkpoint_path, get_matching_source(query_keys, candidate_keys, mode))
+
+    num_candidates = len(candidate_embeddings)
+    checkpoint = read_matching_checkpoint(checkpoint_path)
+    assert all(matched_against <= num_candidates for _, _, matched_against in checkpoint.values()), \
+        f"{checkpoint_path} was written with more candidates than there are now; delete it to start over"
+
+    # queries matched before the candidates grew: only compare them with the candidates added since
+    stale_queries = sorted(
+        query_index for query_index, (_, _, matched_against) in checkpoint.items() 
+        if query_index < len(query_embeddings) and matched_against < num_candidates)
+    if len(stale_queries) > 0:
+        print(f"comparing {len(stale_queries)} already matched queries with the new candidates...")
+    for chunk_start in range(0, len(stale_queries), chunk_size):
+        chunk = np.array(stale_queries[chunk_start:chunk_start + chunk_size])
+        old_matches = [checkpoint[query_index] for query_index in chunk]
+        chunk_indices = np.array([candidate_index for candidate_index, _, _ in old_matches])
+        chunk_similarities = np.array([similarity for _, similarity, _ in old_matches], dtype=np.float32)
+        for matched_against in sorted(set(matched_against for _, _, matched_against in old_matches)):
+            rows = np.array([row for row, (_, _, old_count) in enumerate(old_matches) if old_count == matched_against])
+            new_indices, new_similarities = get_most_similar_indices(
+                query_embeddings[chunk[rows]], candidate_embeddings[matched_against:], normalized=normalized)
+            improved = new_similarities > chunk_similarities[rows]
+            chunk_indices[rows[improved]] = new_indices[improved] + matched_against
+            chunk_similarities[rows[improved]] = new_similarities[improved]
+        append_matching_checkpoint(checkpoint_path, chunk, chunk_indices, chunk_similarities, num_candidates)
+        for query_index, candidate_index, similarity in zip(chunk, chunk_indices, chunk_similarities):
+            checkpoint[int(query_index)] = (int(candidate_index), float(similarity), num_candidates)
+
+    # queries that were never matched
+    new_queries = [query_index for query_index in range(len(query_embeddings)) if query_index not in checkpoint]
+    num_chunks = -(-len(new_queries) // chunk_size)
+    if len(checkpoint) > 0 and num_chunks > 0:
+        print(f"resuming from {checkpoint_path}: {len(checkpoint)} queries already matched")
+    for chunk_number, chunk_start in enumerate(range(0, len(new_queries), chunk_size)):
+        chunk = np.array(new_queries[chunk_start:chunk_start + chunk_size])
+        if ivf_index is not None:
+            chunk_indices, chunk_similarities = search_ivf_index(ivf_index, query_embeddings[chunk], candidate_embeddings, num_probes, normalized=normalized)
+        else:
+            chunk_indices, chunk_similarities = get_most_similar_indices(query_embeddings[chunk], candidate_embeddings, normalized=normalized)
+        append_matching_checkpoint(checkpoint_path, chunk, chunk_indices, chunk_similarities, num_candidates)
+        for query_index, candidate_index, similarity in zip(chunk, chunk_indices, chunk_similarities):
+            checkpoint[int(query_index)] = (int(candidate_index), float(similarity), num_candidates)
+        print(f"matched chunk {chunk_number + 1} of {num_chunks}")
+
+    best_indices = np.array([checkpoint[query_index][0] for query_index in range(len(query_embeddings))], dtype=np.int64)
+    best_similarities = np.array([checkpoint[query_index][1] for query_index in range(len(query_embeddings))], dtype=np.float32)
+    return best_indices, best_similarities
+
+def get_top_k_similar_indices(query_embeddings, candidate_embeddings, k, excluded=None, query_block_size=MATCHING_QUERY_BLOCK_SIZE, candidate_block_size=MATCHING_CANDIDATE_BLOCK_SIZE, normalized=False):
+    """
+    Finds the k most cosine-similar candidates of every query, block by block like get_most_similar_indices, 
+    keeping a running top k per query with argpartition instead of ever holding the full similarity matrix
+    Args:
+        query_embeddings: a numpy matrix with one query embedding per row
+        candidate_embeddings: a numpy matrix with one candidate embedding per row
+        k: the number of candidates to return per query
+        excluded: an optional boolean numpy array with one entry per candidate, True for the candidates to leave out
+        query_block_size, candidate_block_size: the number of queries / candidates per block, which bounds the memory used
+        normalized: whether the embeddings are already L2-normalized (see normalize_embeddings)
+    Returns:
+        A tuple (top_indices, top_similarities) of numpy matrices with one row per query and min(k, number of candidates) columns, 
+        sorted from most to least similar. Slots that can't be filled, because too many candidates are excluded, have index -1 and similarity -inf.
+    """
+    if not normalized:
+        query_embeddings = normalize_embeddings(query_embeddings)
+    k = min(k, len(candidate_embeddings))
+
+    top_indices = np.full((len(query_embeddings), k), -1, dtype=np.int64)
+    top_similarities = np.full((len(query_embeddings), k), -np.inf, dtype=np.float32)
+    if k == 0:
+        return top_indices, top_similarities
+
+    for query_start in range(0, len(query_embeddings), query_block_size):
+        query_block = query_embeddings[query_start:query_start + query_block_size]
+        block_indices = top_indices[query_start:query_start + query_block_size]
+        block_similarities = top_similarities[query_start:query_start + query_block_size]
+
+        for candidate_start in range(0, len(candidate_embeddings), candidate_block_size):
+            candidate_block = get_candidate_block(candidate_embeddings, candidate_start, candidate_start + candidate_block_size, normalized)
+            similarities = query_block @ candidate_block.T
+            if excluded is not None:
+                similarities[:, excluded[candidate_start:candidate_start + len(candidate_block)]] = -np.inf
+
+            # merge this block's candidates into the running top k, then keep the best k of both
+            merged_similarities = np.concatenate([block_similarities, similarities], axis=1)
+            merged_indices = np.concatenate([
+                block_indices, 
+                np.broadcast_to(np.arange(candidate_start, candidate_start + len(candidate_block)), similarities.shape)], axis=1)
+            keep = np.argpartition(-merged_similarities, k - 1, axis=1)[:, :k]
+            block_similarities[:] = np.take_along_axis(merged_similarities, keep, axis=1)
+            block_indices[:] = np.take_along_axis(merged_indices, keep, axis=1)
+
+        order = np.argsort(-block_similarities, axis=1, kind="stable")
+        block_similarities[:] = np.take_along_axis(block_similarities, order, axis=1)
+        block_indices[:] = np.take_along_axis(block_indices, order, axis=1)
+
+    top_indices[~np.isfinite(top_similarities)] = -1
+    return top_indices, top_similarities
+
+def get_one_to_one_matches(query_embeddings, candidate_embeddings, k=10, method="greedy", normalized=False):
+    """
+    Matches queries with candidates without replacement, so that no candidate is matched with more than one query.
+    Only the top k candidates of every query are considered (see get_top_k_similar_indices), so the full similarity matrix is never built.
+    Queries left unmatched because all their top k candidates were taken get another round with twice the k, among the candidates that are still free.
+    Args:
+        query_embeddings: a numpy matrix with one query embedding per row
+        candidate_embeddings: a numpy matrix with one candidate embedding per row
+        k: the number of candidates per query to start with
+        method: "greedy" to take the most similar pairs first, or "optimal" for the assignment that maximizes the total similarity of the top k graph
+        normalized: whether the embeddings are already L2-normalized (see normalize_embeddings)
+    Returns:
+        A tuple (matched_indices, matched_similarities), like get_most_similar_indices. 
+        If there are more queries than candidates, the queries that get no candidate have index -1 and similarity -inf.
+    """
+    assert method == "greedy" or method == "optimal"
+
+    matched_indices = np.full(len(query_embeddings), -1, dtype=np.int64)
+    matched_similarities = np.full(len(query_embeddings), -np.inf, dtype=np.float32)
+    taken = np.zeros(len(candidate_embeddings), dtype=bool)
+    unmatched = np.arange(len(query_embeddings))
+
+    while len(unmatched) > 0 and not taken.all():
+        top_indices, top_similarities = get_top_k_similar_indices(
+            query_embeddings[unmatched], candidate_embeddings, k, excluded=taken, normalized=normalized)
+        rows, columns = np.nonzero(top_indices >= 0)
+
+        if method == "greedy":
+            for edge in np.argsort(-top_similarities[rows, columns], kind="stable"):
+                query = unmatched[rows[edge]]
+                candidate = top_indices[rows[edge], columns[edge]]
+                if matched_indices[query] >= 0 or taken[candidate]:
+                    continue
+                matched_indices[query] = candidate
+                matched_similarities[query] = top_similarities[rows[edge], columns[edge]]
+                taken[candidate] = True
+        else:
+            # minimizing 2 - similarity maximizes the total similarity, and keeps every weight of the graph positive
+            graph = csr_matrix(
+                (2 - top_similarities[rows, columns].astype(np.float64), (rows, top_indices[rows, columns])), 
+                shape=(len(unmatched), len(candidate_embeddings)))
+            try:
+                matched_rows, matched_candidates = min_weight_full_bipartite_matching(graph)
+            except ValueError:
+                # the top k graph has no matching that covers every query yet
+                if k >= len(candidate_embeddings):
+                    raise
+                k *= 2
+                continue
+            matched_indices[unmatched[matched_rows]] = matched_candidates
+            matched_similarities[unmatched[matched_rows]] = 2 - np.asarray(graph[matched_rows, matched_candidates]).ravel()
+            taken[matched_candidates] = True
+
+        unmatched = unmatched[matched_indices[unmatched] < 0]
+        k *= 2
+
+    return matched_indices, matched_similarities
+
+def build_ivf_index(candidate_embeddings, num_lists=None, num_iterations=10, sample_size=None, seed=0):
+    """
+    Builds an inverted-file (IVF) index over the candidates for approximate nearest-neighbour search: 
+    spherical k-means splits the candidates into num_lists clusters, and a query only gets compared with the candidates of its closest clusters
+    Args:
+        candidate_embeddings: a numpy matrix with one candidate embedding per row
+        num_lists: the number of clusters; defaults to 4 * sqrt(number of candidates)
+        num_iterations: the number of k-means iterations
+        sample_size: the number of candidates k-means is trained on; defaults to 64 per cluster
+        seed: the seed of the random sampling, so that the same candidates always give the same index
+    Returns:
+        A dictionary with the keys:
+            "centroids": a float32 matrix with the L2-normalized centroid of every cluster
+            "list_members": the candidate rows, grouped by cluster
+            "list_offsets": an array of length num_lists + 1, so that the members of cluster i are list_members[list_offsets[i]:list_offsets[i + 1]]
+    """
+    num_candidates = len(candidate_embeddings)
+    if num_lists is None:
+        num_lists = max(1, int(4 * np.sqrt(num_candidates)))
+    num_lists = min(num_lists, num_candidates)
+    if sample_size is None:
+        sample_size = 64 * num_lists
+
+    rng = np.random.default_rng(seed)
+    sample = normalize_embeddings(candidate_embeddings[np.sort(rng.choice(num_candidates, size=min(sample_size, num_candidates), replace=False))])
+    centroids = sample[rng.choice(len(sample), size=num_lists, replace=False)]
+    for iteration in range(num_iterations):
+        assignments, _ = get_most_similar_indices(sample, centroids, normalized=True)
+        order = np.argsort(assignments, kind="stable")
+        nonempty_lists, list_starts = np.unique(assignments[order], return_index=True)
+        # clusters that lost all their members keep their old centroid
+        centroids[nonempty_lists] = normalize_embeddings(np.add.reduceat(sample[order], list_starts, axis=0))
+
+    # the candidates get assigned one block at a time, so that a memory-mapped matrix is never copied whole
+    assignments = np.empty(num_candidates, dtype=np.int64)
+    for candidate_start in range(0, num_candidates, MATCHING_CANDIDATE_BLOCK_SIZE):
+        candidate_block = get_candidate_block(candidate_embeddings, candidate_start, candidate_start + MATCHING_CANDIDATE_BLOCK_SIZE, False)
+        assignments[candidate_start:candidate_start + len(candidate_block)], _ = get_most_similar_indices(candidate_block, centroids, normalized=True)
+    list_members = np.argsort(assignments, kind="stable")
+    list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignments, minlength=num_lists), out=list_offsets[1:])
+    return {"centroids": centroids, "list_members": list_members, "list_offsets": list_offsets}
+
+def save_ivf_index(ivf_index, path, source_key=""):
+    """
+    Saves an index from build_ivf_index, along with a key identifying the candidates it was built from (see load_ivf_index)
+    """
+    np.savez(path, source_key=np.array(source_key), **ivf_index)
+
+def load_ivf_index(path, source_key=""):
+    """
+    Returns:
+        The index saved at path, or None if there is none or if it was built from other candidates than the ones source_key identifies
+    """
+    if not exists(path):
+        return None
+    with np.load(path) as saved:
+        if str(saved["source_key"]) != source_key:
+            return None
+        return {name: saved[name] for name in ["centroids", "list_members", "list_offsets"]}
+
+def search_ivf_index(ivf_index, query_embeddings, candidate_embeddings, num_probes=16, normalized=False):
+    """
+    The approximate version of get_most_similar_indices: compares every query only with the candidates of its num_probes closest clusters.
+    More probes give better recall and take longer; num_probes equal to the number of clusters is an exact search.
+    Args:
+        ivf_index: the index returned by build_ivf_index for these candidates
+        query_embeddings: a numpy matrix with one query embedding per row
+        candidate_embeddings: the numpy matrix the index was built from
+        num_probes: the number of clusters to search per query
+        normalized: whether the embeddings are already L2-normalized (see normalize_embeddings)
+    Returns:
+        A tuple (best_indices, best_similarities), like get_most_similar_indices
+    """
+    if not normalized:
+        query_embeddings = normalize_embeddings(query_embeddings)
+    centroids = ivf_index["centroids"]
+    list_members = ivf_index["list_members"]
+    list_offsets = ivf_index["list_offsets"]
+    num_probes = min(num_probes, len(centroids))
+
+    best_indices = np.full(len(query_embeddings), -1, dtype=np.int64)
+    best_similarities = np.full(len(query_embeddings), -np.inf, dtype=np.float32)
+    if len(query_embeddings) == 0 or len(centroids) == 0:
+        return best_indices, best_similarities
+
+    centroid_similarities = query_embeddings @ centroids.T
+    probes = np.argpartition(-centroid_similarities, num_probes - 1, axis=1)[:, :num_probes]
+
+    # group the queries by the clusters they probe, so that each cluster is searched with one matrix multiplication
+    probed_lists = probes.ravel()
+    probing_queries = np.repeat(np.arange(len(query_embeddings)), num_probes)
+    order = np.argsort(probed_lists, kind="stable")
+    probed_lists, probing_queries = probed_lists[order], probing_queries[order]
+    unique_lists, group_starts = np.unique(probed_lists, return_index=True)
+    group_ends = np.append(group_starts[1:], len(probed_lists))
+
+    for list_id, group_start, group_end in zip(unique_lists, group_starts, group_ends):
+        members = list_members[list_offsets[list_id]:list_offsets[list_id + 1]]
+        if len(members) == 0:
+            continue
+        queries = probing_queries[group_start:group_end]
+        member_embeddings = np.asarray(candidate_embeddings[members], dtype=np.float32)
+        if not normalized:
+            member_embeddings = normalize_embeddings(member_embeddings)
+        similarities = query_embeddings[queries] @ member_embeddings.T
+        list_argmax = np.argmax(similarities, axis=1)
+        list_max = similarities[np.arange(len(queries)), list_argmax]
+        list_best = members[list_argmax]
+        # on ties keep the earliest candidate, like the exact search does
+        improved = (list_max > best_similarities[queries]) | ((list_max == best_similarities[queries]) & (list_best < best_indices[queries]))
+        best_indices[queries[improved]] = list_best[improved]
+        best_similarities[queries[improved]] = list_max[improved]
+
+    return best_indices, best_similarities
+
+def get_ivf_recall_report(ivf_index, query_embeddings, candidate_embeddings, num_probes_options=IVF_RECALL_NUM_PROBES):
+    """
+    Measures what approximate search costs in match quality, compared with the exact search, for several numbers of probes
+    Returns:
+        A list of dictionaries, one per number of probes, with the "num_probes", the "recall" (the fraction of queries that get the same match as the exact search),
+        the "mean_similarity_loss" (how much lower the similarity of the matches is on average), the "seconds" taken and the "speedup" over the exact search
+    """
+    start_time = time.time()
+    exact_indices, exact_similarities = get_most_similar_indices(query_embeddings, candidate_embeddings)
+    exact_seconds = time.time() - start_time
+
+    report = []
+    for num_probes in num_probes_options:
+        start_time = time.time()
+        approximate_indices, approximate_similarities = search_ivf_index(ivf_index, query_embeddings, candidate_embeddings, num_probes)
+        seconds = time.time() - start_time
+        report.append({
+            "num_probes": num_probes,
+            "recall": float(np.mean(approximate_indices == exact_indices)),
+            "mean_similarity_loss": float(np.mean(exact_similarities - approximate_similarities)),
+            "seconds": seconds,
+            "speedup": exact_seconds / seconds if seconds > 0 else float("inf")
+        })
+        print(f"num_probes={num_probes}: recall {report[-1]['recall']:.4f}, mean similarity loss {report[-1]['mean_similarity_loss']:.5f}, {seconds:.2f}s ({report[-1]['speedup']:.1f}x faster than exact)")
+    return report
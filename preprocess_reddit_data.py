@@ -1,80 +1,144 @@
-from scrape_reddit import subreddits
+from scrape_reddit import subreddits, iter_scraped_submissions
 import pandas as pd
 import statistics
-from utils import read_talkdown
+import os
+import numpy as np
+from utils import read_talkdown, FILTERED_REDDIT_PATH
+from tokenizer import normalize_sentences, count_tokens, get_any_token_pattern
+from deduplication import create_dedup_state, add_dedup_chunk, get_duplicate_keepers, get_dedup_report
 
 
-dfs_for_each_subreddit = []
-for subreddit in subreddits:
-    df = pd.read_csv(f"data/reddit_scrape/{subreddit}.csv", sep='\t')
-    # post_titles = list(df["title"])
-    print(f"{subreddit} has {len(df)} posts")
-    dfs_for_each_subreddit.append(df)
-    # post_titles = list(post_titles)
-    # print(post_titles[:10])
-all_data = pd.concat(dfs_for_each_subreddit)
-print(f"In total there are {len(all_data)} posts")
+SECOND_PERSON_PRONOUNS = [
+    "you",
+    "your",
+    "youre",
+    "you're",
+    "yall",
+    "y'all",
+    "u",
+    "ur"
+]
+# finds the pronouns among the tokens of a normalized post, tokenized the same way the lexicon scorers tokenize (see tokenizer.tokenize)
+SECOND_PERSON_PRONOUN_PATTERN = get_any_token_pattern(SECOND_PERSON_PRONOUNS)
+PREPROCESS_CHUNK_SIZE = 100000 # the most posts in memory at once
+# every post the deduplication stage removes, with the post that was kept instead
+DEDUP_REPORT_PATH = "data/reddit_scrape_dedup_report.csv"
 
 
-### Read condescending data from TalkDown
-condescending_set = read_talkdown()
-sentence_lengths = [len(sentence) for sentence in condescending_set]
-mean_length = statistics.mean(sentence_lengths)
-sd_length = statistics.stdev(sentence_lengths)
-print(f"Mean of TalkDown length is {mean_length}")
-print(f"Standard Deviation of TalkDown length is {sd_length}")
+def get_length_bounds(condescending_set):
+    """
+    Returns:
+        A tuple (min_length, max_length): the mean length of TalkDown posts -/+ one standard deviation
+    """
+    sentence_lengths = [len(sentence) for sentence in condescending_set]
+    mean_length = statistics.mean(sentence_lengths)
+    sd_length = statistics.stdev(sentence_lengths)
+    print(f"Mean of TalkDown length is {mean_length}")
+    print(f"Standard Deviation of TalkDown length is {sd_length}")
+    return int(mean_length) - int(sd_length), int(mean_length) + int(sd_length)
 
-min_length = int(mean_length) - int(sd_length)
-max_length = int(mean_length) + int(sd_length)
+def filter_posts(posts, min_length, max_length):
+    """
+    Keeps the posts that are strings, have min_length to max_length tokens and have a second person pronoun, working on whole columns at once
+    Args:
+        posts: a dataframe with "title" and "score" columns
+        min_length: the fewest tokens a post can have
+        max_length: the most tokens a post can have
+    Returns:
+        A tuple (filtered_posts, counts): a dataframe with the "sentence" and "score" of the posts that are kept,
+        and a dictionary with the number of posts left after each filter
+    """
+    is_string = posts["title"].notna()
+    titles = posts["title"][is_string].astype(str)
+    num_tokens = count_tokens(titles)
+    has_length = (num_tokens >= min_length) & (num_tokens <= max_length)
+    has_pronoun = normalize_sentences(titles[has_length]).str.contains(SECOND_PERSON_PRONOUN_PATTERN)
+    kept = has_pronoun.index[has_pronoun.to_numpy(dtype=bool)]
 
-def contains_2nd_person_pronouns(tokens):
-    pronouns = [
-        "you",
-        "your",
-        "youre",
-        "you're",
-        "yall",
-        "y'all",
-        "u",
-        "ur"
-    ]
-    for pronoun in pronouns:
-        if pronoun in tokens:
-            return True
-    return False
+    counts = {"posts": len(posts), "strings": int(is_string.sum()), "length": int(has_length.sum()), "pronouns": len(kept)}
+    filtered_posts = pd.DataFrame({"sentence": posts["title"].loc[kept], "score": posts["score"].loc[kept]})
+    return filtered_posts, counts
 
+def filter_scraped_posts(subreddits, min_length, max_length, output_path=FILTERED_REDDIT_PATH, chunk_size=PREPROCESS_CHUNK_SIZE):
+    """
+    Streams the scraped posts of the subreddits through filter_posts a chunk at a time, appending the posts that are kept to output_path as they come,
+    so that memory use depends on chunk_size and not on how much was scraped
+    Args:
+        subreddits: a list of subreddit names
+        min_length: see filter_posts
+        max_length: see filter_posts
+        output_path: the tab-separated file the "sentence" and "score" of the posts that are kept get written to, without a header
+        chunk_size: the most posts per chunk
+    Returns:
+        A dictionary with the number of posts left after each filter, like filter_posts, for all the subreddits together
+    """
+    total_counts = {"posts": 0, "strings": 0, "length": 0, "pronouns": 0}
+    # written to a temporary file first, so that an interrupted run doesn't leave a partial output behind
+    with open(output_path + ".tmp", "w", newline="") as output_file:
+        for subreddit in subreddits:
+            num_posts = 0
+            for chunk in iter_scraped_submissions(subreddit, columns=["title", "score"], batch_size=chunk_size):
+                filtered_chunk, counts = filter_posts(chunk, min_length, max_length)
+                filtered_chunk.to_csv(output_file, sep="\t", index=False, header=False)
+                for name, count in counts.items():
+                    total_counts[name] += count
+                num_posts += len(chunk)
+            print(f"{subreddit} has {num_posts} posts")
+    os.replace(output_path + ".tmp", output_path)
+    return total_counts
 
-# print(f"all_data size: {all_data.size}")
-# print("all_data:")
-# print(all_data.to_string())
+def deduplicate_filtered_posts(path=FILTERED_REDDIT_PATH, report_path=DEDUP_REPORT_PATH, chunk_size=PREPROCESS_CHUNK_SIZE):
+    """
+    Removes the exact and near-duplicate posts (cross-posts, reposts) from the filtered posts at path, keeping the copy with the highest score,
+    and writes a report of what was removed (see deduplication.get_duplicate_keepers).
+    The file is read twice, a chunk at a time: once to compute the MinHash signatures, and once to write the posts that are kept, 
+    so that besides a chunk, only the signatures, ids and scores of the posts and the texts of the duplicates are held in memory
+    Returns:
+        The report, a dataframe with a row per post that was removed
+    """
+    dedup_state = create_dedup_state()
+    for chunk in pd.read_csv(path, sep="\t", header=None, names=["sentence", "score"], chunksize=chunk_size):
+        add_dedup_chunk(dedup_state, chunk["sentence"], chunk["score"])
+    keepers, removed, is_exact, similarities = get_duplicate_keepers(dedup_state)
+    del dedup_state
 
-filtered_data = []
-for index, row in all_data.iterrows():
-    sentence = row[0]
-    score = row[1]
-    print("iterating through all_data")
-    print(f"printing sentence: {sentence}")
+    # the rows the report needs the text of
+    report_rows = np.union1d(removed, keepers[removed])
+    texts = {}
+    scores = {}
+    num_kept = 0
+    with open(path + ".tmp", "w", newline="") as output_file:
+        chunk_start = 0
+        for chunk in pd.read_csv(path, sep="\t", header=None, names=["sentence", "score"], chunksize=chunk_size):
+            rows = np.arange(chunk_start, chunk_start + len(chunk))
+            is_kept = keepers[rows] == rows
+            chunk[is_kept].to_csv(output_file, sep="\t", index=False, header=False)
+            num_kept += int(is_kept.sum())
+            is_reported = np.isin(rows, report_rows)
+            texts.update(zip(rows[is_reported].tolist(), chunk["sentence"].to_numpy()[is_reported]))
+            scores.update(zip(rows[is_reported].tolist(), chunk["score"].to_numpy()[is_reported]))
+            chunk_start += len(chunk)
+    os.replace(path + ".tmp", path)
 
-    if not type(sentence) == str:
-        print("skipping this sample because it's not a string")
-        continue
+    report = get_dedup_report(removed, keepers, is_exact, similarities, texts, scores)
+    report.to_csv(report_path, sep="\t", index=False)
+    print(f"Removed {(report['reason'] == 'exact').sum()} exact and {(report['reason'] == 'near').sum()} near duplicates, {num_kept} posts are left")
+    return report
 
-    # TEMPORARY -- USE A MORE INTELLIGENT TOKENIZER!
-    tokens = sentence.lower().split(" ")
-    print(f"tokens: {tokens}")
-    
+
+if __name__ == "__main__":
+
+    ### Read condescending data from TalkDown
+    condescending_set = read_talkdown()
     # filter by length: find the mean and variance/sd of talkdown, then only keep posts that have length of mean +/- 1 or 2 sd. or 1.5 sd?? idk
-    if len(tokens) < min_length or len(tokens) > max_length:
-        continue
-    
-    # filter for words that have "you" and "your"
-    if not contains_2nd_person_pronouns(tokens):
-        continue
-    
-    filtered_data.append((sentence, score))
+    min_length, max_length = get_length_bounds(condescending_set)
 
-print(f"After filtering there are {len(filtered_data)} posts")
-# After filtering there are 208000 posts
+    # filter for posts that have "you", "your" and the other second person pronouns
+    counts = filter_scraped_posts(subreddits, min_length, max_length)
+    print(f"In total there are {counts['posts']} posts")
+    print(f"{counts['posts'] - counts['strings']} posts aren't strings, {counts['strings'] - counts['length']} have fewer than {min_length} or more than {max_length} tokens, "
+          f"and {counts['length'] - counts['pronouns']} have no second person pronouns")
+    print(f"After filtering there are {counts['pronouns']} posts")
+    # After filtering there are 208000 posts
 
-df = pd.DataFrame(filtered_data, columns=["sentence", "score"])
-df.to_csv("data/reddit_scrape_filtered_with_metadata.csv", sep="\t", index=False, header=False)
\ No newline at end of file
+    deduplicate_filtered_posts()
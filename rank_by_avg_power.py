@@ -1,13 +1,11 @@
 import json
-from utils import read_talkdown, read_VAD_scores, read_veiled_toxicity_clean, read_filtered_reddit, get_sentence_lexicon_score
-
-
-### Get power scores
-power_scores = read_VAD_scores("d") # d for dominance
+from utils import read_talkdown, read_veiled_toxicity_clean, read_filtered_reddit, get_sentence_lexicon_score, get_lexicon
 
 
 def get_sentences_with_power_scores(sentences):
     sentences_with_power = []
+    # power scores come from the lexicon registry, so they only get loaded once, on first use
+    power_scores = get_lexicon("power")
     for sentence in sentences:
         # print(f"SENTENCE: {sentence}")
         # word_power_scores = []
@@ -1,9 +1,14 @@
-from psaw import PushshiftAPI
-import pandas as pd
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import random
+import threading
+import time
 import datetime as dt
-import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-api = PushshiftAPI()
 
 limit = 10000
 
@@ -19,71 +24,373 @@ subreddits = [
 ]
 
 data_fields = [
-    'title', 
-    'score', 
-    'upvote_ratio', 
+    'title',
+    'score',
+    'upvote_ratio',
     'all_awardings'
 ]
 
-if __name__ == "__main__":
+SCRAPE_YEARS = range(2005, 2022) # everything from Jan 1, 2005 (inclusive) to Jan 1, 2022 (exclusive)
+# every subreddit gets a directory here, with a Parquet file per window that had submissions, named {start_epoch}-{end_epoch}.parquet
+SCRAPE_OUTPUT_DIR = "data/reddit_scrape_2"
+# the scrape from before the Parquet windows: a tab-separated {subreddit}.csv per subreddit, with a header line and the LEGACY_SCRAPE_COLUMNS,
+# read when a subreddit has no window files yet
+LEGACY_SCRAPE_DIR = "data/reddit_scrape"
+LEGACY_SCRAPE_COLUMNS = data_fields
+# every (subreddit, month) window that was scraped and written completely gets a line here, so that a rerun skips it
+SCRAPE_LEDGER_FILENAME = "completed_windows.tsv"
+SCRAPE_NUM_WORKERS = 8
+# shared by all the workers, so adding workers overlaps the waiting on the network but never sends requests faster than this
+SCRAPE_REQUESTS_PER_SECOND = 1.0
+SCRAPE_PAGE_SIZE = 100 # the number of submissions Pushshift returns per request
+SCRAPE_MAX_RETRIES = 5
+SCRAPE_BACKOFF_SECONDS = 2.0 # the wait before the first retry of a window, doubled for every retry after that
+SCRAPE_BATCH_SIZE = 1000 # the most submissions held in memory per worker; every batch gets written as one Parquet row group
+# the columns of the scraped data: the submission id and the data_fields, with every awarding reduced to the fields below
+SUBMISSION_AWARDING_TYPE = pa.struct([("name", pa.string()), ("count", pa.int64()), ("coin_price", pa.int64())])
+SUBMISSION_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("title", pa.string()),
+    ("score", pa.int64()),
+    ("upvote_ratio", pa.float64()),
+    ("all_awardings", pa.list_(SUBMISSION_AWARDING_TYPE))
+])
+# the values of the fields that older submissions don't have
+SUBMISSION_FIELD_DEFAULTS = {'upvote_ratio': -1, 'all_awardings': []}
+# every worker thread gets its own Pushshift client
+pushshift_clients = threading.local()
+# the ledger is appended to by several workers
+ledger_lock = threading.Lock()
 
-    for subreddit in subreddits:
 
-        for year in range(2005, 2022): # everything from Jan 1, 2005 (inclusive) to Jan 1, 2022 (exclusive)
-        # for year in range(2020, 2022): # everything from Jan 1, 2005 (inclusive) to Jan 1, 2022 (exclusive)
+def get_pushshift_api():
+    """
+    Creates a Pushshift client once per thread
+    """
+    if not hasattr(pushshift_clients, "api"):
+        # imported here so that the modules importing subreddits from this one don't need psaw installed
+        from psaw import PushshiftAPI
+        pushshift_clients.api = PushshiftAPI()
+    return pushshift_clients.api
 
-            for month in range(1, 13): # every month from January (month 1) to December (month 12)
+def search_pushshift_submissions(subreddit, after, before, limit):
+    """
+    Searches the submissions of a subreddit that were posted between two epochs
+    Returns:
+        A generator of dictionaries, one per submission, with the fields Pushshift returned for it
+    """
+    for submission in get_pushshift_api().search_submissions(subreddit=subreddit, after=after, before=before, limit=limit):
+        yield submission.d_
 
-                start_epoch=int(dt.datetime(year, month, 1).timestamp())
+def get_month_windows(subreddits, years):
+    """
+    Returns:
+        A list with a dictionary per subreddit and month of the years, with the "subreddit",
+        and the "start_epoch" (inclusive) and "end_epoch" (exclusive) of the month
+    """
+    windows = []
+    for subreddit in subreddits:
+        for year in years:
+            for month in range(1, 13): # every month from January (month 1) to December (month 12)
+                start_epoch = int(dt.datetime(year, month, 1).timestamp())
                 if month < 12:
-                    end_epoch=int(dt.datetime(year, month + 1, 1).timestamp())
+                    end_epoch = int(dt.datetime(year, month + 1, 1).timestamp())
                 else:
-                    end_epoch=int(dt.datetime(year + 1, 1, 1).timestamp())
+                    end_epoch = int(dt.datetime(year + 1, 1, 1).timestamp())
+                windows.append({"subreddit": subreddit, "start_epoch": start_epoch, "end_epoch": end_epoch})
+    return windows
 
-                api_request_generator = api.search_submissions(
-                    subreddit=subreddit, 
-                    after=start_epoch,
-                    before=end_epoch, 
-                    limit=limit)
+def get_window_name(window):
+    return f"{window['subreddit']} {dt.datetime.fromtimestamp(window['start_epoch']):%m-%Y}"
 
-                # let's see if theres anything in here
-                # print(next(api_request_generator))
+def create_rate_limiter(requests_per_second):
+    """
+    Returns:
+        A rate limiter for wait_for_rate_limit, which can be shared by several threads
+    """
+    return {"lock": threading.Lock(), "interval": 1 / requests_per_second, "next_time": time.monotonic()}
 
-                submissions = pd.DataFrame([submission.d_ for submission in api_request_generator])
-                if len(submissions) == 0:
-                    continue
-                if len(submissions) == limit:
-                    print(f"\n!!!!!!!!!! {subreddit} {month}-{year} exceeded limit: {submissions.shape}\n")
+def wait_for_rate_limit(rate_limiter):
+    """
+    Blocks until the next request is allowed. Every caller reserves its own time slot, so concurrent callers are spread out evenly
+    """
+    with rate_limiter["lock"]:
+        now = time.monotonic()
+        request_time = max(now, rate_limiter["next_time"])
+        rate_limiter["next_time"] = request_time + rate_limiter["interval"]
+    time.sleep(request_time - now)
+
+def fetch_window(search_submissions, window, rate_limiter, max_retries=SCRAPE_MAX_RETRIES, backoff_seconds=SCRAPE_BACKOFF_SECONDS, batch_size=SCRAPE_BATCH_SIZE):
+    """
+    Fetches the submissions of a window, up to limit of them, starting over with exponential backoff when a request fails.
+    The batches of an attempt that failed have been yielded already, so the submissions of the attempt after it can repeat them.
+    Args:
+        search_submissions: a function like search_pushshift_submissions
+        window: a dictionary from get_month_windows
+        rate_limiter: the rate limiter from create_rate_limiter that every request waits for
+        max_retries: the number of times the window is retried before giving up
+        backoff_seconds: the wait before the first retry, doubled for every retry after that
+        batch_size: the number of submissions per batch
+    Yields:
+        Lists of at most batch_size dictionaries, one per submission
+    Returns:
+        The number of submissions that the attempt that succeeded fetched
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            num_fetched = 0
+            batch = []
+            wait_for_rate_limit(rate_limiter)
+            # Pushshift leaves out both ends of after and before, so that the window is start_epoch (inclusive) to end_epoch (exclusive) like get_month_windows says
+            for submission in search_submissions(subreddit=window["subreddit"], after=window["start_epoch"] - 1, before=window["end_epoch"], limit=limit):
+                batch.append(submission)
+                num_fetched += 1
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+                # the search fetches the next page once this one is used up
+                if num_fetched % SCRAPE_PAGE_SIZE == 0:
+                    wait_for_rate_limit(rate_limiter)
+            if len(batch) > 0:
+                yield batch
+            return num_fetched
+        except Exception as error:
+            if attempt == max_retries:
+                raise
+            # the random jitter keeps the workers that failed together from retrying together
+            delay = backoff_seconds * 2 ** attempt * (1 + random.random())
+            print(f"{get_window_name(window)} failed ({error!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def fetch_window_completely(search_submissions, window, rate_limiter, max_retries=SCRAPE_MAX_RETRIES, backoff_seconds=SCRAPE_BACKOFF_SECONDS, batch_size=SCRAPE_BATCH_SIZE):
+    """
+    Fetches all the submissions of a window, however many there are: a window that hits the limit gets split in two halves, 
+    which get fetched the same way, until every part of it is under the limit. 
+    So only the busy windows pay for the extra requests, instead of raising the limit for every window.
+    The batches of a window that hit the limit have been yielded already, so the batches of its halves repeat them; deduplicate_submissions drops the repeats.
+    Args:
+        see fetch_window
+    Yields:
+        Lists of at most batch_size dictionaries, one per submission
+    """
+    num_fetched = yield from fetch_window(search_submissions, window, rate_limiter, max_retries, backoff_seconds, batch_size)
+    if num_fetched < limit:
+        return
+    if window["end_epoch"] - window["start_epoch"] < 2:
+        print(f"\n!!!!!!!!!! {window['subreddit']} has {num_fetched} submissions in the second {window['start_epoch']}, which can't be split any further\n")
+        return
+
+    middle_epoch = (window["start_epoch"] + window["end_epoch"]) // 2
+    print(f"{window['subreddit']} {dt.datetime.fromtimestamp(window['start_epoch'])} to {dt.datetime.fromtimestamp(window['end_epoch'])} hit the limit of {limit} submissions, splitting it in two")
+    for start_epoch, end_epoch in [(window["start_epoch"], middle_epoch), (middle_epoch, window["end_epoch"])]:
+        half_window = {"subreddit": window["subreddit"], "start_epoch": start_epoch, "end_epoch": end_epoch}
+        yield from fetch_window_completely(search_submissions, half_window, rate_limiter, max_retries, backoff_seconds, batch_size)
 
-                print(f"\n########## {subreddit} {month}-{year} submissions shape: {submissions.shape}\n")
-                # print(DecidingToBeBetter_submissions[['title', 'score']].sample(10))
-                # data_to_keep = submissions[['title', 'score']]
-                
-                # for column_name in data_fields:
-                #     if column_name not in submissions: 
-                #         submissions[column_name] = np.nan
+def deduplicate_submissions(submissions, seen_ids):
+    """
+    Args:
+        submissions: a list of dictionaries, one per submission
+        seen_ids: a set with the ids of the submissions kept so far, which gets the ids of the new ones added to it
+    Returns:
+        The submissions whose ids aren't in seen_ids, keeping only the first of the ones with the same id
+    """
+    new_submissions = []
+    for submission in submissions:
+        submission_id = submission.get("id")
+        if submission_id is not None:
+            if submission_id in seen_ids:
+                continue
+            seen_ids.add(submission_id)
+        new_submissions.append(submission)
+    return new_submissions
 
-                if 'upvote_ratio' not in submissions:
-                    submissions['upvote_ratio'] = -1
-                if 'all_awardings' not in submissions:
-                    submissions['all_awardings'] = np.empty((len(submissions), 0)).tolist()
+def get_data_to_keep(submissions):
+    """
+    Returns:
+        A pyarrow table with the SUBMISSION_SCHEMA columns of the submissions, filling in the fields that older submissions don't have
+    """
+    columns = {}
+    for field in SUBMISSION_SCHEMA.names:
+        columns[field] = [submission.get(field, SUBMISSION_FIELD_DEFAULTS.get(field)) for submission in submissions]
+    columns['all_awardings'] = [
+        [{name: awarding.get(name) for name in ["name", "count", "coin_price"]} for awarding in awardings or []] 
+        for awardings in columns['all_awardings']]
+    return pa.Table.from_pydict(columns, schema=SUBMISSION_SCHEMA)
 
-                data_to_keep = submissions[['title', 'score', 'upvote_ratio', 'all_awardings']]
-                # print(data_to_keep['author_flair_css_class'])
-                # print(data_to_keep['author_flair_text'])
-                # print(data_to_keep['score'])
-                # print(data_to_keep['link_flair_text'])
-                # print(data_to_keep['all_awardings'])
-                # for item in data_to_keep["all_awardings"]:
-                #     if len(item) > 0:
-                #         print(item)
-                
-                print(f"data_to_keep shape: {data_to_keep.shape}")
-                for col in data_to_keep.columns:
-                    print(col)
+def read_scraped_submissions(subreddit, columns=None, scrape_dir=SCRAPE_OUTPUT_DIR, legacy_scrape_dir=LEGACY_SCRAPE_DIR):
+    """
+    Reads the submissions scraped from a subreddit. A subreddit without any window file is read from its legacy TSV instead, if it has one
+    Args:
+        subreddit: the name of the subreddit
+        columns: the SUBMISSION_SCHEMA columns to read, or None for all of them
+        scrape_dir: the output_dir of scrape_windows
+        legacy_scrape_dir: the directory of the legacy TSVs, see LEGACY_SCRAPE_DIR, or None to only read the window files
+    Returns:
+        A dataframe with a row per submission
+    """
+    subreddit_dir = join(scrape_dir, subreddit)
+    window_paths = get_window_paths(subreddit_dir) if exists(subreddit_dir) else []
+    if len(window_paths) == 0 and has_legacy_scrape(subreddit, legacy_scrape_dir):
+        legacy_chunks = list(iter_legacy_scraped_submissions(subreddit, columns, legacy_scrape_dir=legacy_scrape_dir))
+        if len(legacy_chunks) > 0:
+            return pd.concat(legacy_chunks, ignore_index=True)
+    if len(window_paths) == 0:
+        return SUBMISSION_SCHEMA.empty_table().select(columns or SUBMISSION_SCHEMA.names).to_pandas()
+    return pq.read_table(window_paths, columns=columns, schema=SUBMISSION_SCHEMA).to_pandas()
 
-                data_to_keep.to_csv(f"data/reddit_scrape_2/{subreddit}.csv", mode='a', sep="\t", header=False, index=False)
+def iter_scraped_submissions(subreddit, columns=None, batch_size=SCRAPE_BATCH_SIZE, scrape_dir=SCRAPE_OUTPUT_DIR, legacy_scrape_dir=LEGACY_SCRAPE_DIR):
+    """
+    Reads the submissions scraped from a subreddit a batch at a time, so that only one batch is in memory at once.
+    A subreddit without any window file is streamed from its legacy TSV instead, if it has one
+    Args:
+        see read_scraped_submissions
+        batch_size: the most submissions per batch
+    Yields:
+        Dataframes with a row per submission
+    """
+    subreddit_dir = join(scrape_dir, subreddit)
+    window_paths = get_window_paths(subreddit_dir) if exists(subreddit_dir) else []
+    if len(window_paths) == 0 and has_legacy_scrape(subreddit, legacy_scrape_dir):
+        print(f"no windows scraped for {subreddit} in {scrape_dir}, reading {get_legacy_scrape_path(subreddit, legacy_scrape_dir)} instead")
+        yield from iter_legacy_scraped_submissions(subreddit, columns, batch_size, legacy_scrape_dir)
+    for window_path in window_paths:
+        for batch in pq.ParquetFile(window_path).iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pandas()
 
+def get_legacy_scrape_path(subreddit, legacy_scrape_dir=LEGACY_SCRAPE_DIR):
+    return join(legacy_scrape_dir, f"{subreddit}.csv")
 
+def has_legacy_scrape(subreddit, legacy_scrape_dir=LEGACY_SCRAPE_DIR):
+    return legacy_scrape_dir is not None and exists(get_legacy_scrape_path(subreddit, legacy_scrape_dir))
 
+def iter_legacy_scraped_submissions(subreddit, columns=None, batch_size=SCRAPE_BATCH_SIZE, legacy_scrape_dir=LEGACY_SCRAPE_DIR):
+    """
+    Streams the legacy TSV of a subreddit (see LEGACY_SCRAPE_DIR) a chunk of rows at a time.
+    Like the preprocessing that read these files before, the first line is the header and the columns are taken by position.
+    The legacy TSVs don't have every SUBMISSION_SCHEMA column (e.g. the id), so if any column asked for is missing, nothing is yielded
+    Args:
+        see iter_scraped_submissions
+    Yields:
+        Dataframes with a row per submission and the LEGACY_SCRAPE_COLUMNS that were asked for
+    """
+    for chunk in pd.read_csv(get_legacy_scrape_path(subreddit, legacy_scrape_dir), sep="\t", chunksize=batch_size):
+        chunk = chunk.iloc[:, :len(LEGACY_SCRAPE_COLUMNS)]
+        chunk.columns = LEGACY_SCRAPE_COLUMNS[:chunk.shape[1]]
+        missing_columns = [column for column in columns or [] if column not in chunk.columns]
+        if len(missing_columns) > 0:
+            print(f"the legacy scrape of {subreddit} has no {missing_columns} columns, skipping it")
+            return
+        yield chunk if columns is None else chunk[columns]
+
+def get_window_paths(subreddit_dir):
+    """
+    Returns:
+        The paths of the finished window files of a subreddit, in the order of their windows
+    """
+    window_filenames = [filename for filename in os.listdir(subreddit_dir) if filename.endswith(".parquet") and not filename.startswith(".")]
+    window_filenames.sort(key=lambda filename: int(filename.split("-")[0]))
+    return [join(subreddit_dir, filename) for filename in window_filenames]
+
+def read_scrape_ledger(ledger_path):
+    """
+    Returns:
+        A set with a (subreddit, start_epoch, end_epoch) tuple for every window in the ledger
+    """
+    completed_windows = set()
+    if exists(ledger_path):
+        with open(ledger_path) as ledger_file:
+            for line in ledger_file:
+                fields = line.rstrip("\n").split("\t")
+                # a line cut off by an interrupted write doesn't count
+                if len(fields) == 4:
+                    completed_windows.add((fields[0], int(fields[1]), int(fields[2])))
+    return completed_windows
+
+def append_scrape_ledger(ledger_path, window, num_submissions):
+    with ledger_lock, open(ledger_path, "a") as ledger_file:
+        ledger_file.write(f"{window['subreddit']}\t{window['start_epoch']}\t{window['end_epoch']}\t{num_submissions}\n")
+        ledger_file.flush()
+        os.fsync(ledger_file.fileno())
+
+def scrape_windows(windows, search_submissions=search_pushshift_submissions, output_dir=SCRAPE_OUTPUT_DIR, num_workers=SCRAPE_NUM_WORKERS,
+                   requests_per_second=SCRAPE_REQUESTS_PER_SECOND, max_retries=SCRAPE_MAX_RETRIES, backoff_seconds=SCRAPE_BACKOFF_SECONDS, batch_size=SCRAPE_BATCH_SIZE):
+    """
+    Scrapes windows concurrently, and writes the SUBMISSION_SCHEMA columns of the submissions of every window to {output_dir}/{subreddit}/{start_epoch}-{end_epoch}.parquet.
+    Submissions are written a batch at a time as they arrive, so the memory used doesn't depend on how many submissions a window has.
+    Windows already in the ledger of output_dir are skipped, so an interrupted scrape can be rerun to finish it; see read_scraped_submissions to read the results.
+    Args:
+        windows: a list of dictionaries from get_month_windows
+        search_submissions: a function like search_pushshift_submissions; anything with the same arguments and results works, like a local stand-in for Pushshift
+        output_dir: the directory of the scraped data and the ledger
+        num_workers: the number of windows scraped at the same time
+        requests_per_second: the most requests sent per second, by all the workers together
+        max_retries: see fetch_window
+        backoff_seconds: see fetch_window
+        batch_size: see fetch_window
+    Returns:
+        A list of the windows that still failed after all their retries; they aren't in the ledger, so the next run tries them again
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    ledger_path = join(output_dir, SCRAPE_LEDGER_FILENAME)
+    completed_windows = read_scrape_ledger(ledger_path)
+    pending_windows = [
+        window for window in windows
+        if (window["subreddit"], window["start_epoch"], window["end_epoch"]) not in completed_windows]
+    print(f"{len(windows) - len(pending_windows)} of {len(windows)} windows were scraped before, scraping the other {len(pending_windows)}...")
+
+    rate_limiter = create_rate_limiter(requests_per_second)
+    ids_lock = threading.Lock()
+    # the ids of the submissions written so far, per subreddit, so that a submission is written once even if two windows return it;
+    # only the window files count, the legacy TSVs have no ids and get replaced by the windows anyway
+    written_ids = {}
+    for subreddit in set(window["subreddit"] for window in pending_windows):
+        os.makedirs(join(output_dir, subreddit), exist_ok=True)
+        written_ids[subreddit] = set(read_scraped_submissions(subreddit, ["id"], output_dir, legacy_scrape_dir=None)["id"])
+
+    def scrape_window(window):
+        window_path = join(output_dir, window["subreddit"], f"{window['start_epoch']}-{window['end_epoch']}.parquet")
+        # the window gets written to a hidden file first, so that read_scraped_submissions never reads an unfinished window
+        temporary_path = join(output_dir, window["subreddit"], f".{window['start_epoch']}-{window['end_epoch']}.parquet.tmp")
+        if exists(window_path):
+            # the window was written completely, but the run stopped before it got into the ledger
+            num_written = pq.ParquetFile(window_path).metadata.num_rows
+            append_scrape_ledger(ledger_path, window, num_written)
+            return num_written
+        writer = None
+        num_written = 0
+        try:
+            for batch in fetch_window_completely(search_submissions, window, rate_limiter, max_retries, backoff_seconds, batch_size):
+                with ids_lock:
+                    batch = deduplicate_submissions(batch, written_ids[window["subreddit"]])
+                if len(batch) == 0:
+                    continue
+                if writer is None:
+                    writer = pq.ParquetWriter(temporary_path, SUBMISSION_SCHEMA, compression="zstd")
+                writer.write_table(get_data_to_keep(batch))
+                num_written += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is not None:
+            os.replace(temporary_path, window_path)
+        append_scrape_ledger(ledger_path, window, num_written)
+        return num_written
+
+    failed_windows = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(scrape_window, window): window for window in pending_windows}
+        for num_done, future in enumerate(as_completed(futures)):
+            window = futures[future]
+            try:
+                print(f"########## {get_window_name(window)}: {future.result()} submissions ({num_done + 1} of {len(pending_windows)} windows)")
+            except Exception as error:
+                print(f"{get_window_name(window)} failed after {max_retries} retries: {error!r}")
+                failed_windows.append(window)
+    if len(failed_windows) > 0:
+        print(f"{len(failed_windows)} windows failed; run again to retry them")
+    return failed_windows
+
+
+if __name__ == "__main__":
 
+    scrape_windows(get_month_windows(subreddits, SCRAPE_YEARS))
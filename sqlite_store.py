@@ -0,0 +1,62 @@
+import sqlite3
+
+
+SQLITE_STORE_QUERY_SIZE = 500 # keys per query, well under sqlite's limit on query parameters
+
+
+def open_sqlite_store(path, table, namespace_column, value_column, value_type, namespace):
+    """
+    Opens an on-disk key-value table, where every value is stored under a namespace (e.g. a model name or a feature fingerprint) and a sentence hash
+    Args:
+        path: the sqlite file
+        table: the name of the table, created if it doesn't exist yet
+        namespace_column: the name of the column holding the namespace
+        value_column: the name of the column holding the values
+        value_type: the sqlite type of the values, e.g. "TEXT" or "BLOB"
+        namespace: the namespace that values are read and written under
+    Returns:
+        A dictionary with the sqlite "connection", the "namespace" and the names of the "table", "namespace_column" and "value_column"
+    """
+    connection = sqlite3.connect(path)
+    connection.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            {namespace_column} TEXT NOT NULL,
+            sentence_hash TEXT NOT NULL,
+            {value_column} {value_type} NOT NULL,
+            PRIMARY KEY ({namespace_column}, sentence_hash)
+        ) WITHOUT ROWID""")
+    return {"connection": connection, "namespace": namespace, "table": table, "namespace_column": namespace_column, "value_column": value_column}
+
+def read_sqlite_store(store, sentence_hashes):
+    """
+    Looks sentence hashes up in a store
+    Args:
+        store: the store returned by open_sqlite_store
+        sentence_hashes: an iterable of sentence hashes (str)
+    Returns:
+        A dictionary, where the keys (str) are the hashes that were found and values are their stored values, as sqlite returns them
+    """
+    sentence_hashes = list(sentence_hashes)
+    values = {}
+    for start in range(0, len(sentence_hashes), SQLITE_STORE_QUERY_SIZE):
+        batch = sentence_hashes[start:start + SQLITE_STORE_QUERY_SIZE]
+        placeholders = ", ".join("?" * len(batch))
+        cursor = store["connection"].execute(
+            f"SELECT sentence_hash, {store['value_column']} FROM {store['table']} "
+            f"WHERE {store['namespace_column']} = ? AND sentence_hash IN ({placeholders})",
+            [store["namespace"]] + batch)
+        for sentence_hash, value in cursor:
+            values[sentence_hash] = value
+    return values
+
+def write_sqlite_store(store, values):
+    """
+    Adds values to a store, replacing the ones already stored under the same hashes
+    Args:
+        store: the store returned by open_sqlite_store
+        values: a dictionary, where the keys (str) are sentence hashes and values are what to store for them
+    """
+    store["connection"].executemany(
+        f"INSERT OR REPLACE INTO {store['table']} ({store['namespace_column']}, sentence_hash, {store['value_column']}) VALUES (?, ?, ?)",
+        [(store["namespace"], sentence_hash, value) for sentence_hash, value in values.items()])
+    store["connection"].commit()
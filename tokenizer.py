@@ -0,0 +1,159 @@
+import re
+import sys
+import itertools
+import numpy as np
+import pandas as pd
+
+
+# a token is a run of letters and digits, with inner apostrophes and hyphens kept, e.g. "don't" and "self-esteem";
+# everything else (spaces, punctuation, underscores) separates tokens
+TOKEN_PATTERN = re.compile(r"[^\W_]+(?:['\-][^\W_]+)*")
+# bump this whenever tokenize or join_phrases changes, so that features computed with the old tokens don't get reused (see get_feature_fingerprint)
+TOKENIZER_VERSION = "2"
+TOKEN_CACHE_MAX_SIZE = 1000000 # sentences; the cache starts over once it's this big
+# the tokens of every sentence tokenized so far by this process, see get_tokens
+token_cache = {}
+# key under which a node of a phrase index stores the lexicon entry whose tokens end there; not a token, so it can't collide with one
+PHRASE_INDEX_ENTRY = None
+
+
+def normalize_sentence(sentence):
+    """
+    Lowercases a sentence, like the words of the lexicons are, and turns curly apostrophes into straight ones
+    """
+    return sentence.lower().replace("’", "'")
+
+def tokenize(sentence):
+    """
+    Args:
+        sentence: a string
+    Returns:
+        A list of the tokens (str) of the sentence, lowercased, without punctuation
+    """
+    return TOKEN_PATTERN.findall(normalize_sentence(sentence))
+
+def get_tokens(sentence):
+    """
+    The cached version of tokenize, so that a sentence only gets tokenized once per process, however many scorers and datasets use it
+    Returns:
+        A tuple of the tokens (str) of the sentence; equal tokens are the same interned string, so they are stored once
+    """
+    tokens = token_cache.get(sentence)
+    if tokens is None:
+        if len(token_cache) >= TOKEN_CACHE_MAX_SIZE:
+            token_cache.clear()
+        tokens = tuple(sys.intern(token) for token in tokenize(sentence))
+        token_cache[sentence] = tokens
+    return tokens
+
+def build_phrase_index(entries):
+    """
+    Indexes the multi-word entries of a lexicon (e.g. "give up") by their tokens, for join_phrases
+    Args:
+        entries: the entries (str) of a lexicon; the ones that tokenize into a single token are left out
+    Returns:
+        A trie of the multi-word entries, as nested dictionaries keyed by token;
+        the node where the tokens of an entry end has a PHRASE_INDEX_ENTRY entry holding the entry
+    """
+    phrase_index = {}
+    for entry in entries:
+        entry_tokens = tokenize(entry)
+        if len(entry_tokens) < 2:
+            continue
+        node = phrase_index
+        for token in entry_tokens:
+            node = node.setdefault(token, {})
+        node[PHRASE_INDEX_ENTRY] = entry
+    return phrase_index
+
+def join_phrases(tokens, phrase_index):
+    """
+    Replaces every phrase of a phrase index found in the tokens of a sentence with its lexicon entry, so that it gets looked up as one unit instead of word by word.
+    Phrases are matched leftmost-longest and don't overlap. Only the trie is walked from every token, never the list of phrases, 
+    so this takes time linear in the number of tokens (times the length of the longest phrase), however many phrases are indexed
+    Args:
+        tokens: the tokens of a sentence, as returned by get_tokens
+        phrase_index: the trie returned by build_phrase_index
+    Returns:
+        The tokens themselves when no phrase was found, otherwise a tuple of the tokens with every phrase joined into its entry (str)
+    """
+    # most sentences contain no first word of any phrase
+    if phrase_index.keys().isdisjoint(tokens):
+        return tokens
+    units = []
+    start = 0
+    while start < len(tokens):
+        node = phrase_index.get(tokens[start])
+        phrase_end = None
+        position = start
+        while node is not None:
+            position += 1
+            if PHRASE_INDEX_ENTRY in node:
+                phrase_end, entry = position, node[PHRASE_INDEX_ENTRY]
+            node = node.get(tokens[position]) if position < len(tokens) else None
+        if phrase_end is None:
+            units.append(tokens[start])
+            start += 1
+        else:
+            units.append(entry)
+            start = phrase_end
+    return tuple(units)
+
+def clear_token_cache():
+    """
+    Empties the cache of get_tokens, e.g. after a batch of sentences that won't be seen again
+    """
+    token_cache.clear()
+
+def tokenize_corpus(sentences, phrase_index=None):
+    """
+    Tokenizes a whole corpus at once into integer token ids, stored as a ragged array (CSR layout)
+    Args:
+        sentences: a list of strings
+        phrase_index: the trie returned by build_phrase_index, to join the phrases of the sentences into single tokens (see join_phrases)
+    Returns:
+        A tuple (token_ids, offsets, vocabulary):
+            token_ids: a numpy array of the ids of every token of every sentence, back to back
+            offsets: a numpy array of length len(sentences) + 1, so that the tokens of sentence i are token_ids[offsets[i]:offsets[i + 1]]
+            vocabulary: a list of the distinct tokens (str), where the token with id i is vocabulary[i]
+    """
+    tokenized_sentences = [get_tokens(sentence) for sentence in sentences]
+    if phrase_index:
+        tokenized_sentences = [join_phrases(tokens, phrase_index) for tokens in tokenized_sentences]
+    sentence_lengths = np.fromiter(
+        (len(tokens) for tokens in tokenized_sentences), dtype=np.int64, count=len(tokenized_sentences))
+    offsets = np.zeros(len(tokenized_sentences) + 1, dtype=np.int64)
+    np.cumsum(sentence_lengths, out=offsets[1:])
+
+    all_tokens = list(itertools.chain.from_iterable(tokenized_sentences))
+    if len(all_tokens) == 0:
+        return np.zeros(0, dtype=np.int64), offsets, []
+    token_ids, vocabulary = pd.factorize(pd.Series(all_tokens, dtype=object))
+    return token_ids.astype(np.int64), offsets, list(vocabulary)
+
+def normalize_sentences(sentences):
+    """
+    The pandas version of normalize_sentence, for a whole column of sentences at once.
+    The column is made an object column first: pandas runs the regular expressions of Arrow-backed string columns on RE2, 
+    where \\W only knows ASCII, so the .str methods would find other tokens than tokenize in non-ASCII text
+    """
+    return sentences.astype(object).str.lower().str.replace("’", "'", regex=False)
+
+def count_tokens(sentences):
+    """
+    Counts the tokens of a whole column of sentences at once, without building the lists of tokens
+    Args:
+        sentences: a pandas series of strings
+    Returns:
+        A pandas series with the number of tokens tokenize finds in every sentence
+    """
+    return normalize_sentences(sentences).str.count(TOKEN_PATTERN)
+
+def get_any_token_pattern(words):
+    """
+    Returns:
+        A compiled regular expression that finds, in a normalized sentence (see normalize_sentence), the tokens that are one of the words
+    """
+    alternatives = "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+    # a match can't be part of a longer token: no letter or digit right before or after it, nor an apostrophe or hyphen joining it to one
+    return re.compile(r"(?<![^\W_])(?<![^\W_]['\-])(?:" + alternatives + r")(?![^\W_])(?!['\-][^\W_])")
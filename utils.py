@@ -1,32 +1,133 @@
-from os.path import exists
-import json
+from os.path import exists, join
 import pandas as pd
 import numpy as np
-import csv
-import re
 import statsmodels.stats.descriptivestats as descriptivestats
 from scipy import stats
 import matplotlib.pyplot as plt
 import math
 import seaborn as sns
 import random
-
-
-def read_talkdown():
+import os
+import itertools
+import hashlib
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+from feature_cache import (
+    FEATURE_CACHE_DIR,
+    FEATURE_CACHE_MAX_SIZE,
+    FEATURE_CACHE_FORMAT,
+    FEATURE_FRAME_EXTENSIONS,
+    hash_sentences,
+    get_feature_fingerprint,
+    get_dataset_key,
+    hash_sentence,
+    read_cached_dataframe,
+    write_cached_dataframe,
+    open_feature_store,
+    read_feature_rows,
+    write_feature_rows,
+    write_feature_frame,
+    open_feature_dataset)
+from lexicons import (
+    read_VAD_scores,
+    read_concreteness,
+    read_LIWC_lexicon,
+    compile_LIWC_lexicon,
+    is_compiled_LIWC_lexicon,
+    get_LIWC_token_categories,
+    get_lexicon,
+    get_merged_lexicon,
+    get_phrase_index,
+    read_compiled_lexicons,
+    get_compiled_lexicons_sources,
+    get_lexicon_hash)
+from tokenizer import TOKENIZER_VERSION, tokenize, get_tokens, join_phrases, tokenize_corpus, clear_token_cache
+from embeddings import get_sentence_embeddings, load_or_generate_embedding_store, read_embedding_store, write_embedding_store
+from matching import (
+    get_most_similar_indices,
+    get_most_similar_indices_resumable,
+    get_one_to_one_matches,
+    build_ivf_index,
+    save_ivf_index,
+    load_ivf_index,
+    search_ivf_index,
+    get_ivf_recall_report,
+    IVF_RECALL_NUM_PROBES,
+    get_matching_source,
+    read_matching_source,
+    write_matching_source)
+from numpy import dot
+from numpy.linalg import norm
+try:
+    # parses TalkDown several times faster than json when it's installed
+    from orjson import loads as parse_json
+except ImportError:
+    from json import loads as parse_json
+
+
+# the LIWC categories that get_feature_vector turns into count / binary / normalized features
+LIWC_FEATURE_CATEGORIES = ["anger", "social", "relig", "sexual", "humans"]
+# the columns of a feature vector, in the order get_feature_vector returns them
+FEATURE_COLUMNS = ['power', 'agency', 'sentiment', 'concreteness'] + [
+    f"{category}_{suffix}" for category in LIWC_FEATURE_CATEGORIES for suffix in ["count", "binary", "normalized"]]
+# the type of every column of a feature dataset, see generate_feature_dataset
+FEATURE_DATASET_SCHEMA = pa.schema(
+    [('is_empowering', pa.int64())] + [
+    (column, pa.int64() if column.endswith(("_count", "_binary")) else pa.float64()) for column in FEATURE_COLUMNS])
+FEATURE_DATASET_BATCH_SIZE = 100000 # sentences per batch, and rows per row group of a feature dataset
+READ_FILTERED_REDDIT_CHUNK_SIZE = 100000 # rows per read of the filtered posts, see iter_filtered_reddit
+# the names get_lexicon knows the lexicons of get_feature_vector by, in the order of its arguments
+FEATURE_LEXICON_NAMES = ["power", "agency", "sentiment", "concreteness", "liwc"]
+# the lexicons of a feature extraction worker process, set once by init_feature_worker
+feature_worker_lexicons = None
+TALKDOWN_DATA_DIR = "data/talkdown/data"
+# written by preprocess_reddit_data.py, with the "sentence" and "score" of every post that passed its filters
+FILTERED_REDDIT_PATH = "data/reddit_scrape_filtered.csv"
+
+
+def iter_talkdown(split="train", balanced=True, fields=("quotedpost",), label=True):
+    """
+    Reads TalkDown one line at a time, so that only the fields that are asked for of the samples that are kept are ever held in memory
+    Args:
+        split: "train", "dev" or "test"
+        balanced: True for the balanced_{split}.jsonl files, False for the full, unbalanced {split}.jsonl files
+        fields: the fields of every sample to keep, e.g. 'quotedpost' (just the part that someone replied to pointing out that it's condescending)
+                or 'post' (the entire post, which contains quotedpost plus more context)
+        label: True to only keep the samples labeled as condescending, False to only keep the others, or None to keep all of them
+    Yields:
+        A dictionary with the fields of every sample that is kept
+    """
+    filename = f"balanced_{split}.jsonl" if balanced else f"{split}.jsonl"
+    with open(join(TALKDOWN_DATA_DIR, filename), "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = parse_json(line)
+            if label is not None and bool(data['label']) != label:
+                continue
+            yield {field: data[field] for field in fields}
+
+def read_talkdown(split="train", balanced=True):
     """
     Reads condescending data from TalkDown.
+    Args:
+        split: see iter_talkdown
+        balanced: see iter_talkdown
     Returns:
         A list of strings, where each string is the 'quotedpost' field 
     """
-    condescending_set = []
-    with open("data/talkdown/data/balanced_train.jsonl") as f:
-        json_list = list(f)
-    for json_str in json_list:
-        data = json.loads(json_str)
-        if data['label']: # if it's labeled as True for condescending
-            condescending_set.append(data['quotedpost']) # This is just the part that someone replied to pointing out that it's condescending
-            # condescending_set.append(data['post']) # This is the entire post, which contains quotedpost plus more context
-    return condescending_set
+    return [sample['quotedpost'] for sample in iter_talkdown(split, balanced)]
+
+def iter_filtered_reddit(chunk_size=READ_FILTERED_REDDIT_CHUNK_SIZE):
+    """
+    Reads the filtered data scraped from 8 empowering subreddits a chunk of rows at a time, so that only chunk_size titles are ever held in memory
+    Yields:
+        Every post title (str)
+    """
+    for chunk in pd.read_csv(FILTERED_REDDIT_PATH, sep="\t", header=None, usecols=[0], chunksize=chunk_size):
+        yield from chunk[0].tolist()
 
 def read_filtered_reddit():
     """
@@ -34,9 +135,7 @@ def read_filtered_reddit():
     Returns:
         A list of strings, where each string is a post title
     """
-    df = pd.read_csv("data/reddit_scrape_filtered.csv", sep="\t", header=None)
-    empowering_set = df.values.reshape(-1).tolist() # reshape flattens it because every string is in its own list, making a big list of lists    
-    return empowering_set
+    return list(iter_filtered_reddit())
 
 def read_filtered_reddit_with_metadata():
     """
@@ -44,7 +143,7 @@ def read_filtered_reddit_with_metadata():
     Returns:
         A dataframe
     """
-    df = pd.read_csv("data/reddit_scrape_filtered.csv", sep="\t", header=None, names=["sentence", "score"])
+    df = pd.read_csv(FILTERED_REDDIT_PATH, sep="\t", header=None, names=["sentence", "score"])
     # empowering_set = df.values.reshape(-1).tolist() # reshape flattens it because every string is in its own list, making a big list of lists    
     return df
 
@@ -77,96 +176,23 @@ def read_veiled_toxicity_clean():
     clean_set = [sentence for sentence, _ in clean_set]
     return clean_set
 
-def read_VAD_scores(dimension_to_load):
+def get_sentence_lexicon_score(sentence, lexicon, tokens=None):
     """
-    Reads dominance (aka power) from the VAD lexicon. 
-    Args:
-        dimension_to_load: a string with just 3 options to specify which dimension to load: 
-                           "v" (valence / sentiment), "a" (arousal / agency), "d" (dominance / power)
-    Returns:
-        A dictionary, where keys (str) are the words in the lexicon and values (float) are their power score
-    """
-    assert dimension_to_load == "v" or dimension_to_load == "a" or dimension_to_load == "d"
-    power_scores = {}
-    with open(f'lexicons/NRC-VAD-Lexicon-Aug2018Release/OneFilePerDimension/{dimension_to_load}-scores.txt') as f:
-        lines = f.readlines()
-        for line in lines:
-            line = line.strip()
-            word, score = line.split("\t")
-            power_scores[word] = float(score)
-            # print(f"power_scores[{word}] = {float(score)}")
-    return power_scores
-
-def read_concreteness():
-    """
-    Reads concreteness scores from the concreteness lexicon.
-    Returns: 
-        A dictionary, where the keys (str) are the words in the lexicon and values (float) are their power score
-    """
-    # TODO: this currently doesn't account for the bigrams and only treats everything in the lexicon as a single word
-    concreteness_scores = {}
-    with open('lexicons/concreteness.csv', newline='') as csvfile:
-        csv_reader = csv.reader(csvfile)
-        next(csv_reader)
-        for row in csv_reader:
-            # print(row)
-            token = row[0]
-            concreteness_mean_score = float(row[2])
-            concreteness_scores[token] = concreteness_mean_score
-    return concreteness_scores
-
-def read_LIWC_lexicon():
-    """
-    Reads the LIWC lexicon.
-    Returns:
-        A dictionary, where the keys (str) are the names of categories, and values (list) are lists of words / word prefixes (str) that fall under that category.
-    """
-    liwc_words_by_category = {}
-    category_num_to_name = {}
-
-    with open(f'lexicons/LIWC2007_English080730.dic') as f:
-        lines = f.readlines()
-        words_start_at = None
-
-        # read the categories first
-        for index in range(1, len(lines)):
-            line = lines[index]
-            line = line.strip()
-            if line == "%":
-                words_start_at = index + 1
-                break
-            number, category = line.split("\t")
-            # print(f"category: {category}, number: {number}")
-            liwc_words_by_category[category] = []
-            category_num_to_name[int(number)] = category
-
-        # then read the lines with words followed by category numbers
-        for line in lines[words_start_at:]:
-            line = line.strip()
-            line = re.sub("<.*?>|[()/ ]", "\t", line)
-            elements = line.split("\t")
-            word = elements[0]
-            categories = elements[1:]
-            for category_number in categories:
-                if category_number == "":
-                    continue
-                category_name = category_num_to_name[int(category_number)]
-                liwc_words_by_category[category_name].append(word)
-
-    return liwc_words_by_category
-
-def get_sentence_lexicon_score(sentence, lexicon):
-    """
-    Goes through each token in a sentence, looks it up in a given lexicon, collects scores of all the words found, and returns their average 
+    Goes through each token in a sentence, looks it up in a given lexicon, collects scores of all the words found, and returns their average.
+    The multi-word entries of the lexicon found in the sentence count as one word each, instead of their separate words (see tokenizer.join_phrases)
     Args:
         sentence: a string 
         lexicon: a dictionary where the keys (str) are the words in the lexicon and values (float) are their score
+        tokens: the tokens of the sentence, if they were already looked up with get_tokens
     Returns:
         Average score of words in the sentence that did exist in the lexicon
         None if no words in the sentence were found in the lexicon
     """
+    if tokens is None:
+        tokens = get_tokens(sentence)
+    tokens = join_phrases(tokens, get_phrase_index(lexicon))
     individual_word_scores = []
-    for word in sentence.split():
+    for word in tokens:
         if word in lexicon:
             individual_word_scores.append(lexicon[word])
     # should I just skip anything that doesn't have any token in the power lexicon?
@@ -175,41 +201,99 @@ def get_sentence_lexicon_score(sentence, lexicon):
     sentence_avg_power = sum(individual_word_scores) / len(individual_word_scores) # if len(individual_word_scores) > 0 else None
     return sentence_avg_power
 
-def is_prefix(word, prefix):
-    prefix = prefix[1:]
-    return word.startswith(prefix)
+def get_sentence_merged_lexicon_scores(sentence, merged_lexicon, num_lexicons, tokens=None):
+    """
+    The single pass version of get_sentence_lexicon_score for several lexicons at once: looks every token up once in a merged lexicon
+    and averages the scores of the words found in each of the lexicons it was merged from. Tokens are looked up one by one, so multi-word entries never match;
+    get_sentence_multi_lexicon_scores takes care of the lexicons that have some
+    Args:
+        sentence: a string
+        merged_lexicon: the dictionary returned by lexicons.merge_lexicons
+        num_lexicons: the number of lexicons that were merged
+        tokens: the tokens of the sentence, if they were already looked up with get_tokens
+    Returns:
+        A list with the average score of the sentence in every merged lexicon, in the order they were merged, 
+        or 0 for the lexicons in which no words of the sentence were found
+    """
+    if tokens is None:
+        tokens = get_tokens(sentence)
+    # one lookup per token; map, filter and zip keep the whole pass out of the interpreter loop
+    entries = list(filter(None, map(merged_lexicon.get, tokens)))
+    if len(entries) == 0:
+        return [0] * num_lexicons
+    scores, masks = zip(*entries)
+    # adding the 0.0 of the lexicons a word isn't in leaves their sums unchanged, so every sum is the one get_sentence_lexicon_score gets
+    score_sums = map(sum, zip(*scores))
+    score_counts = map(sum, zip(*masks))
+    return [score_sum / score_count if score_count > 0 else 0 for score_sum, score_count in zip(score_sums, score_counts)]
+
+def get_sentence_multi_lexicon_scores(sentence, lexicons, tokens=None):
+    """
+    Scores a sentence with several lexicons, giving exactly what get_sentence_lexicon_score gives for each of them, 
+    but in a single pass over the tokens with their merged lexicon (see get_sentence_merged_lexicon_scores). 
+    The phrases of a lexicon with multi-word entries only replace their words for that lexicon, so its score gets recomputed with them joined
+    when the sentence has one, while the other lexicons keep seeing the separate words
+    Args:
+        sentence: a string
+        lexicons: a list of dictionaries where the keys (str) are the words in the lexicon and values (float) are their score
+        tokens: the tokens of the sentence, if they were already looked up with get_tokens
+    Returns:
+        A list with the average score of the sentence in every lexicon, in the order of lexicons
+    """
+    if tokens is None:
+        tokens = get_tokens(sentence)
+    average_scores = get_sentence_merged_lexicon_scores(sentence, get_merged_lexicon(lexicons), len(lexicons), tokens)
+    for lexicon_index, lexicon in enumerate(lexicons):
+        phrase_index = get_phrase_index(lexicon)
+        # join_phrases hands the tokens themselves back when the sentence has none of the phrases
+        if phrase_index and join_phrases(tokens, phrase_index) is not tokens:
+            average_scores[lexicon_index] = get_sentence_lexicon_score(sentence, lexicon, tokens)
+    return average_scores
+
+def get_LIWC_counts(sentence, liwc_matcher, categories, tokens=None):
+    """
+    Counts the words in a sentence that fall under each of the given LIWC categories
+    Args:
+        sentence: a string
+        liwc_matcher: the compiled matcher returned by compile_LIWC_lexicon
+        categories: a list of the LIWC categories (str) for which we're trying to count words in the sentence
+        tokens: the tokens of the sentence, if they were already looked up with get_tokens
+    Returns:
+        A dictionary, where the keys (str) are the categories and values are tuples in the same format as get_LIWC_count: 
+            (category_count, category_binary, category_normalized)
+    """
+    if tokens is None:
+        tokens = get_tokens(sentence)
+    counts = {category: 0 for category in categories}
+    for sentence_token in tokens:
+        for category in get_LIWC_token_categories(sentence_token, liwc_matcher):
+            if category in counts:
+                counts[category] += 1
+
+    return {
+        category: (count, 1 if count > 0 else 0, count / len(sentence))
+        for category, count in counts.items()}
 
 def get_LIWC_count(sentence, liwc_words_by_category, category):
     """
     Goes through each token in a sentence, looks it up in the LIWC dictionary, and returns a list of counts of the specified categories
     Args:
         sentence: a string
-        liwc_words_by_category: A dictionary, where the keys (str) are the names of categories, and values (list) are lists of words / word prefixes (str) that fall under that category
+        liwc_words_by_category: the compiled matcher returned by compile_LIWC_lexicon. The raw dictionary from read_LIWC_lexicon is also accepted, 
+                                but then it gets compiled on every call, so prefer compiling it once up front
         category: the LIWC category to for which we're trying to count words in the sentence
     Returns:
         A tuple of three numbers (integers and float) that contains the count of words in the sentence that fall under the specified category, followed by its binary version (1 if count is anything greater than 0), followed by the count divided by the sentence length.
             Tuple format: (category_count, category_binary, category_normalized)
     """
-    count = 0
-    words_in_this_category = liwc_words_by_category[category]
-    for word_in_category in words_in_this_category:
-        # handle regular words
-        if word_in_category in sentence.split():
-            count = count + sentence.count(word_in_category)
-        # handle word prefixes
-        elif '*' in word_in_category:            
-            for sentence_token in sentence.split():
-                if is_prefix(word=sentence_token, prefix=word_in_category):
-                    count = count + 1
-
-    return (
-        count,
-        1 if count > 0 else 0,
-        count / len(sentence))
+    liwc_matcher = liwc_words_by_category
+    if not is_compiled_LIWC_lexicon(liwc_matcher):
+        liwc_matcher = compile_LIWC_lexicon(liwc_words_by_category)
+    return get_LIWC_counts(sentence, liwc_matcher, [category])[category]
 
 def get_sentences_with_power_scores(sentences):
     sentences_with_power = []
-    power_scores = read_VAD_scores('d')
+    power_scores = get_lexicon("power")
     for sentence in sentences:
         sentence_avg_power = get_sentence_lexicon_score(sentence, power_scores)
         if sentence_avg_power is None:
@@ -219,8 +303,16 @@ def get_sentences_with_power_scores(sentences):
     return sentences_with_power
 
 def save_descriptive_stats(data, out_file):
+    """
+    Saves the descriptive statistics of every column of data. The format follows the extension of out_file: 
+    .parquet or .arrow for columnar files, anything else for a tab-separated file
+    """
     data_description = descriptivestats.describe(data)
-    data_description.to_csv(out_file, sep='\t')
+    if out_file.endswith(FEATURE_FRAME_EXTENSIONS["parquet"]) or out_file.endswith(FEATURE_FRAME_EXTENSIONS["arrow"]):
+        data_description.columns = [str(column) for column in data_description.columns]
+        write_feature_frame(data_description, out_file)
+    else:
+        data_description.to_csv(out_file, sep='\t')
 
 def print_model_summaries(models):
     for model_name, model in models.items():
@@ -238,18 +330,46 @@ def remove_outliers(data):
     return trimmed_data
 
 
-def get_feature_vector(sentence, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category):
-    avg_power = get_sentence_lexicon_score(sentence, power_scores)
-    avg_agency = get_sentence_lexicon_score(sentence, agency_scores)
-    avg_sentiment = get_sentence_lexicon_score(sentence, sentiment_scores)
-
-    avg_concreteness = get_sentence_lexicon_score(sentence, concreteness_scores)
-
-    anger_count, anger_binary, anger_normalized = get_LIWC_count(sentence, liwc_words_by_category, "anger")
-    social_count, social_binary, social_normalized = get_LIWC_count(sentence, liwc_words_by_category, "social")
-    relig_count, relig_binary, relig_normalized = get_LIWC_count(sentence, liwc_words_by_category, "relig")
-    sexual_count, sexual_binary, sexual_normalized = get_LIWC_count(sentence, liwc_words_by_category, "sexual")
-    humans_count, humans_binary, humans_normalized = get_LIWC_count(sentence, liwc_words_by_category, "humans")
+def get_feature_fingerprint_of_lexicons(power_scores=None, agency_scores=None, sentiment_scores=None, concreteness_scores=None, liwc_words_by_category=None):
+    """
+    Args:
+        power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category: the lexicons, same as for load_or_generate_dataframe;
+            the ones left as None are the registry lexicons, which are identified by the lexicon files they were compiled from, and the others by their contents
+    Returns:
+        The feature fingerprint (str) of the lexicons, the FEATURE_COLUMNS and the tokenizer, to open the feature store with
+    """
+    lexicons = [power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category]
+    lexicons_hash = get_compiled_lexicons_sources() if any(lexicon is None for lexicon in lexicons) else None
+    if any(lexicon is not None for lexicon in lexicons):
+        # the registry lexicons alone keep the plain hash of the lexicon files, so features cached before custom lexicons were fingerprinted still get reused
+        lexicon_hashes = [None if lexicon is None else get_lexicon_hash(lexicon) for lexicon in lexicons]
+        lexicons_hash = hashlib.sha256(json.dumps([lexicons_hash, lexicon_hashes]).encode("utf-8")).hexdigest()
+    return get_feature_fingerprint(lexicons_hash, FEATURE_COLUMNS, TOKENIZER_VERSION)
+
+def get_feature_vector(sentence, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category, feature_store=None):
+    if feature_store is not None:
+        sentence_hash = hash_sentence(sentence)
+        stored_rows = read_feature_rows(feature_store, [sentence_hash])
+        if sentence_hash in stored_rows:
+            return stored_rows[sentence_hash]
+        feature_vector = get_feature_vector(sentence, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category)
+        write_feature_rows(feature_store, {sentence_hash: feature_vector})
+        return feature_vector
+
+    if not is_compiled_LIWC_lexicon(liwc_words_by_category):
+        liwc_words_by_category = compile_LIWC_lexicon(liwc_words_by_category)
+
+    # tokenized once, for all the lexicons, and every token looked up once in all four score lexicons
+    tokens = get_tokens(sentence)
+    avg_power, avg_agency, avg_sentiment, avg_concreteness = get_sentence_multi_lexicon_scores(
+        sentence, [power_scores, agency_scores, sentiment_scores, concreteness_scores], tokens)
+
+    liwc_counts = get_LIWC_counts(sentence, liwc_words_by_category, LIWC_FEATURE_CATEGORIES, tokens)
+    anger_count, anger_binary, anger_normalized = liwc_counts["anger"]
+    social_count, social_binary, social_normalized = liwc_counts["social"]
+    relig_count, relig_binary, relig_normalized = liwc_counts["relig"]
+    sexual_count, sexual_binary, sexual_normalized = liwc_counts["sexual"]
+    humans_count, humans_binary, humans_normalized = liwc_counts["humans"]
 
     feature_vector = [
         avg_power, 
@@ -264,39 +384,297 @@ def get_feature_vector(sentence, power_scores, agency_scores, sentiment_scores,
     
     return feature_vector
 
-def load_or_generate_dataframe(condescending_set, empowering_set, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category, abridged=False, matched=False):
-    data = [] 
-    filename = "data_abridged.pkl" if abridged else "data_unabridged.pkl"
-    if matched:
-        filename = "data_matched.pkl" 
-    if exists(filename):
+def get_lexicon_lookup_array(lexicon, vocabulary):
+    """
+    Turns a lexicon into an array indexed by token id
+    Args:
+        lexicon: a dictionary where the keys (str) are the words in the lexicon and values (float) are their score
+        vocabulary: a list of tokens (str), as returned by tokenize_corpus
+    Returns:
+        A numpy array of floats with the score of every token in the vocabulary, or NaN for tokens that aren't in the lexicon
+    """
+    return np.array([lexicon.get(token, np.nan) for token in vocabulary], dtype=np.float64)
+
+def get_merged_lexicon_lookup_matrix(merged_lexicon, num_lexicons, vocabulary):
+    """
+    Turns a merged lexicon into a matrix indexed by token id, with a single lookup per token
+    Args:
+        merged_lexicon: the dictionary returned by lexicons.merge_lexicons
+        num_lexicons: the number of lexicons that were merged
+        vocabulary: a list of tokens (str), as returned by tokenize_corpus
+    Returns:
+        A numpy array of shape (len(vocabulary), num_lexicons) with the score of every token in every lexicon, or NaN where a token isn't in a lexicon
+    """
+    lookup_matrix = np.full((len(vocabulary), num_lexicons), np.nan)
+    entries = [merged_lexicon.get(token) for token in vocabulary]
+    found_token_ids = [token_id for token_id, entry in enumerate(entries) if entry is not None]
+    if len(found_token_ids) > 0:
+        scores, masks = zip(*[entries[token_id] for token_id in found_token_ids])
+        lookup_matrix[found_token_ids] = np.where(np.array(masks, dtype=bool), np.array(scores, dtype=np.float64), np.nan)
+    return lookup_matrix
+
+def get_LIWC_lookup_matrix(liwc_matcher, vocabulary, categories):
+    """
+    Turns the compiled LIWC matcher into a matrix indexed by token id
+    Args:
+        liwc_matcher: the compiled matcher returned by compile_LIWC_lexicon
+        vocabulary: a list of tokens (str), as returned by tokenize_corpus
+        categories: a list of LIWC categories (str)
+    Returns:
+        A numpy array of shape (len(vocabulary), len(categories)) with a 1 wherever a token falls under a category
+    """
+    category_index = {category: index for index, category in enumerate(categories)}
+    lookup_matrix = np.zeros((len(vocabulary), len(categories)), dtype=np.int64)
+    for token_id, token in enumerate(vocabulary):
+        for category in get_LIWC_token_categories(token, liwc_matcher):
+            if category in category_index:
+                lookup_matrix[token_id, category_index[category]] = 1
+    return lookup_matrix
+
+def get_sentence_lexicon_scores(token_ids, offsets, lexicon_lookup):
+    """
+    The batch version of get_sentence_lexicon_score: averages the scores of the tokens found in the lexicon, for every sentence at once
+    Args:
+        token_ids, offsets: the ragged token array returned by tokenize_corpus
+        lexicon_lookup: the array returned by get_lexicon_lookup_array, or the matrix returned by get_merged_lexicon_lookup_matrix
+    Returns:
+        A numpy array with the average score of every sentence, or 0 if none of its words were found in the lexicon.
+        For a lookup matrix, a matrix with a column per lexicon
+    """
+    num_sentences = len(offsets) - 1
+    lookup_matrix = lexicon_lookup if lexicon_lookup.ndim == 2 else lexicon_lookup[:, None]
+    sentence_ids = np.repeat(np.arange(num_sentences), np.diff(offsets))
+    # NaN (not in the lexicon) becomes a score of 0.0 that isn't counted, so every token of every sentence gets added up in one pass per lexicon
+    found = ~np.isnan(lookup_matrix)
+    scores = np.where(found, lookup_matrix, 0.0)
+    average_scores = np.zeros((num_sentences, lookup_matrix.shape[1]))
+    for lexicon_index in range(lookup_matrix.shape[1]):
+        # bincount adds the weights of each sentence up in token order, and adding 0.0 changes nothing, so the sums are exactly the ones sum() gives
+        score_sums = np.bincount(sentence_ids, weights=scores[token_ids, lexicon_index], minlength=num_sentences)
+        score_counts = np.bincount(sentence_ids, weights=found[token_ids, lexicon_index], minlength=num_sentences)
+        np.divide(score_sums, score_counts, out=average_scores[:, lexicon_index], where=score_counts > 0)
+    if lexicon_lookup.ndim == 1:
+        return average_scores[:, 0]
+    return average_scores
+
+def get_feature_dataframe(sentences, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category):
+    """
+    The batch version of get_feature_vector: tokenizes the whole corpus once and computes every feature with array operations
+    Args:
+        sentences: a list of strings
+        power_scores, agency_scores, sentiment_scores, concreteness_scores: lexicon dictionaries, same as for get_feature_vector
+        liwc_words_by_category: the compiled LIWC matcher (or the raw dictionary from read_LIWC_lexicon)
+    Returns:
+        A dataframe with one row per sentence and the FEATURE_COLUMNS as columns, with the same values get_feature_vector returns
+    """
+    if not is_compiled_LIWC_lexicon(liwc_words_by_category):
+        liwc_words_by_category = compile_LIWC_lexicon(liwc_words_by_category)
+
+    token_ids, offsets, vocabulary = tokenize_corpus(sentences)
+    num_sentences = len(offsets) - 1
+
+    features = {}
+    score_columns = ['power', 'agency', 'sentiment', 'concreteness']
+    score_lexicons = [power_scores, agency_scores, sentiment_scores, concreteness_scores]
+    merged_lexicon = get_merged_lexicon(score_lexicons)
+    lexicon_lookup = get_merged_lexicon_lookup_matrix(merged_lexicon, len(score_columns), vocabulary)
+    average_scores = get_sentence_lexicon_scores(token_ids, offsets, lexicon_lookup)
+    # a lexicon with multi-word entries scores a corpus with its own phrases joined into single tokens (see get_sentence_multi_lexicon_scores);
+    # the other lexicons and LIWC keep seeing every word
+    for column_index, lexicon in enumerate(score_lexicons):
+        phrase_index = get_phrase_index(lexicon)
+        if phrase_index:
+            phrase_token_ids, phrase_offsets, phrase_vocabulary = tokenize_corpus(sentences, phrase_index)
+            average_scores[:, column_index] = get_sentence_lexicon_scores(
+                phrase_token_ids, phrase_offsets, get_lexicon_lookup_array(lexicon, phrase_vocabulary))
+    for column_index, column in enumerate(score_columns):
+        features[column] = average_scores[:, column_index]
+
+    liwc_lookup = get_LIWC_lookup_matrix(liwc_words_by_category, vocabulary, LIWC_FEATURE_CATEGORIES)
+    sentence_ids = np.repeat(np.arange(num_sentences), np.diff(offsets))
+    sentence_char_lengths = np.fromiter((len(sentence) for sentence in sentences), dtype=np.int64, count=num_sentences)
+    for category_index, category in enumerate(LIWC_FEATURE_CATEGORIES):
+        counts = np.bincount(
+            sentence_ids, 
+            weights=liwc_lookup[token_ids, category_index], 
+            minlength=num_sentences).astype(np.int64)
+        features[f"{category}_count"] = counts
+        features[f"{category}_binary"] = (counts > 0).astype(np.int64)
+        features[f"{category}_normalized"] = counts / sentence_char_lengths
+
+    return pd.DataFrame(features, columns=FEATURE_COLUMNS)
+
+def get_feature_lexicons(power_scores=None, agency_scores=None, sentiment_scores=None, concreteness_scores=None, liwc_words_by_category=None):
+    """
+    Returns:
+        A list of the lexicons of get_feature_vector, in the order of its arguments, where the ones left as None come from the lexicon registry (see get_lexicon)
+    """
+    lexicons = [power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category]
+    return [lexicon if lexicon is not None else get_lexicon(name) for lexicon, name in zip(lexicons, FEATURE_LEXICON_NAMES)]
+
+def init_feature_worker(power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category):
+    """
+    Initializer of the feature extraction worker processes: stores the lexicons once per worker, 
+    so that only the sentences get sent along with every task.
+    The lexicons that are None get loaded by the worker itself from the lexicon registry, which decodes them from the compiled lexicon file (see lexicons.read_compiled_lexicons),
+    so they never get pickled over from the parent; every worker still builds its own dictionaries from the file
+    """
+    global feature_worker_lexicons
+    feature_worker_lexicons = tuple(get_feature_lexicons(power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category))
+
+def get_feature_dataframe_in_worker(sentences):
+    return get_feature_dataframe(sentences, *feature_worker_lexicons)
+
+def get_feature_dataframe_parallel(sentences, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category, num_workers, chunk_size=10000):
+    """
+    Splits the sentences into chunks and runs get_feature_dataframe on them in a pool of worker processes
+    Args:
+        sentences: a list of strings
+        power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category: the lexicons, same as for get_feature_dataframe;
+            the ones that are None come from the lexicon registry (see get_lexicon), loaded by every worker itself instead of getting sent to it
+        num_workers: the number of worker processes
+        chunk_size: the number of sentences in each task
+    Returns:
+        A dataframe with one row per sentence, in the same order as the sentences, and the FEATURE_COLUMNS as columns
+    """
+    if liwc_words_by_category is not None and not is_compiled_LIWC_lexicon(liwc_words_by_category):
+        liwc_words_by_category = compile_LIWC_lexicon(liwc_words_by_category)
+
+    chunks = [sentences[start:start + chunk_size] for start in range(0, len(sentences), chunk_size)]
+    if len(chunks) <= 1 or num_workers <= 1:
+        return get_feature_dataframe(sentences, *get_feature_lexicons(power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category))
+
+    if any(lexicon is None for lexicon in [power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category]):
+        # compiles the lexicon file here if it's missing or stale, so that the workers only ever read a finished one
+        read_compiled_lexicons()
+    print(f"extracting features from {len(chunks)} chunks with {num_workers} workers...")
+    with ProcessPoolExecutor(
+            max_workers=num_workers, 
+            initializer=init_feature_worker, 
+            initargs=(power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category)) as executor:
+        # map yields the results in the order of the chunks, no matter which worker finishes first
+        chunk_features = list(executor.map(get_feature_dataframe_in_worker, chunks))
+    return pd.concat(chunk_features, ignore_index=True)
+
+def load_or_generate_dataframe(condescending_set, empowering_set, power_scores=None, agency_scores=None, sentiment_scores=None, concreteness_scores=None, liwc_words_by_category=None, num_workers=1, cache_dir=FEATURE_CACHE_DIR, max_cache_size=FEATURE_CACHE_MAX_SIZE, storage_format=FEATURE_CACHE_FORMAT, columns=None):
+    """
+    Builds the dataframe of labels and features for a condescending and an empowering set, going through the feature cache:
+    a dataset is cached under a hash of its sentences, the lexicons and the feature columns, and when it isn't cached yet, 
+    it gets assembled from the feature store, computing features only for the sentences that were never seen before
+    Args:
+        condescending_set: a list of strings, labeled 0
+        empowering_set: a list of strings, labeled 1
+        power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category: the lexicons, same as for get_feature_vector;
+            the ones left as None come from the lexicon registry (see get_lexicon), and only get loaded if there are new sentences to compute features for
+        num_workers: the number of processes to extract features with
+        cache_dir: the directory of the feature cache
+        max_cache_size: the size in bytes past which the least recently used datasets get evicted from the cache
+        storage_format: the format new datasets get cached in, "parquet", "arrow" or "pickle"
+        columns: a list of the columns to return, e.g. only the ones a model formula uses; cached datasets then only load those columns
+    Returns:
+        A dataframe with the 'is_empowering' label followed by the FEATURE_COLUMNS, or only the requested columns
+    """
+    sentences = list(condescending_set) + list(empowering_set)
+    # the label: 0 means condescending, 1 means empowering
+    labels = [0] * len(condescending_set) + [1] * len(empowering_set)
+
+    sentence_hashes = hash_sentences(sentences)
+    fingerprint = get_feature_fingerprint_of_lexicons(power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category)
+    key = get_dataset_key(sentence_hashes, labels, fingerprint)
+
+    data = read_cached_dataframe(key, cache_dir, columns)
+    if data is not None:
         print("loading data...")
-        data = pd.read_pickle(filename)
-    else:
-        for sentence in condescending_set:
-            data_point = [0] + get_feature_vector(sentence, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category)
-            data.append(data_point)
-
-        for sentence in empowering_set:
-            data_point = [1] + get_feature_vector(sentence, power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category)
-            data.append(data_point)
-
-        data = pd.DataFrame(data, columns = [
-            'is_empowering', # the label: 0 means condescending, 1 means empowering
-            'power', 
-            'agency',
-            'sentiment',
-            'concreteness',
-            "anger_count", "anger_binary", "anger_normalized",
-            "social_count", "social_binary", "social_normalized",
-            "relig_count", "relig_binary", "relig_normalized",
-            "sexual_count", "sexual_binary", "sexual_normalized",
-            "humans_count", "humans_binary", "humans_normalized"])
-
-        print("saving data to file...")
-        data.to_pickle(filename)
+        return data
+
+    feature_store = open_feature_store(fingerprint, cache_dir)
+    feature_rows = read_feature_rows(feature_store, set(sentence_hashes))
+    new_sentences = {}
+    for sentence, sentence_hash in zip(sentences, sentence_hashes):
+        if sentence_hash not in feature_rows and sentence_hash not in new_sentences:
+            new_sentences[sentence_hash] = sentence
+    print(f"found features for {len(feature_rows)} sentences in the feature store, computing {len(new_sentences)} new ones...")
+
+    # the lexicons left as None get loaded by whichever process extracts the features (see get_feature_dataframe_parallel)
+    lexicons = [power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category]
+    if len(new_sentences) == 0:
+        # nothing to compute, so don't load any lexicon just to get an empty frame
+        lexicons = [{}, {}, {}, {}, compile_LIWC_lexicon({})]
+    new_features = get_feature_dataframe_parallel(list(new_sentences.values()), *lexicons, num_workers=num_workers)
+    # tolist per column turns the numpy values back into python ints and floats
+    new_rows = dict(zip(new_sentences.keys(), zip(*[new_features[column].tolist() for column in FEATURE_COLUMNS])))
+    write_feature_rows(feature_store, new_rows)
+    feature_store["connection"].close()
+    feature_rows.update(new_rows)
+
+    data = pd.DataFrame(
+        [feature_rows[sentence_hash] for sentence_hash in sentence_hashes], 
+        columns=FEATURE_COLUMNS).astype(new_features.dtypes.to_dict())
+    data.insert(0, 'is_empowering', labels)
+
+    print("saving data to file...")
+    write_cached_dataframe(key, data, fingerprint, cache_dir, max_cache_size, storage_format)
     
-    return data
+    return data if columns is None else data[columns]
+
+def generate_feature_dataset(condescending_sentences, empowering_sentences, out_path, power_scores=None, agency_scores=None, sentiment_scores=None, concreteness_scores=None, liwc_words_by_category=None, batch_size=FEATURE_DATASET_BATCH_SIZE, cache_dir=FEATURE_CACHE_DIR):
+    """
+    The out-of-core version of load_or_generate_dataframe, for corpora that don't fit in memory: reads the sentences from iterators 
+    (e.g. iter_filtered_reddit, or the 'quotedpost' of iter_talkdown), computes their features a batch at a time, going through the feature store like
+    load_or_generate_dataframe does, and appends every batch to a Parquet file as its own row group. 
+    Memory use depends on batch_size and not on the number of sentences: the sentences, features and token caches of a batch are dropped before the next one,
+    since every sentence only comes once
+    Args:
+        condescending_sentences: an iterable of strings, labeled 0
+        empowering_sentences: an iterable of strings, labeled 1
+        out_path: the Parquet file to write the dataset to
+        power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category: the lexicons, same as for load_or_generate_dataframe
+        batch_size: the number of sentences per batch
+        cache_dir: the directory of the feature store
+    Returns:
+        The dataset, opened lazily with open_feature_dataset, with the 'is_empowering' label followed by the FEATURE_COLUMNS (see FEATURE_DATASET_SCHEMA)
+    """
+    fingerprint = get_feature_fingerprint_of_lexicons(power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category)
+    feature_store = open_feature_store(fingerprint, cache_dir)
+    lexicons = [power_scores, agency_scores, sentiment_scores, concreteness_scores, liwc_words_by_category]
+    num_rows = 0
+    num_new_rows = 0
+    # written to a temporary file first, so that an interrupted run doesn't leave a partial dataset behind
+    schema = FEATURE_DATASET_SCHEMA.with_metadata({"fingerprint": fingerprint})
+    with pq.ParquetWriter(out_path + ".tmp", schema, compression="zstd") as writer:
+        for label, sentences in [(0, condescending_sentences), (1, empowering_sentences)]:
+            sentences = iter(sentences)
+            while True:
+                batch = list(itertools.islice(sentences, batch_size))
+                if len(batch) == 0:
+                    break
+                sentence_hashes = hash_sentences(batch)
+                feature_rows = read_feature_rows(feature_store, set(sentence_hashes))
+                new_sentences = {}
+                for sentence, sentence_hash in zip(batch, sentence_hashes):
+                    if sentence_hash not in feature_rows and sentence_hash not in new_sentences:
+                        new_sentences[sentence_hash] = sentence
+                if len(new_sentences) > 0:
+                    # the lexicons only get loaded once some sentence needs them
+                    lexicons = get_feature_lexicons(*lexicons)
+                    new_features = get_feature_dataframe(list(new_sentences.values()), *lexicons)
+                    new_rows = dict(zip(new_sentences.keys(), zip(*[new_features[column].tolist() for column in FEATURE_COLUMNS])))
+                    write_feature_rows(feature_store, new_rows)
+                    feature_rows.update(new_rows)
+                    # the tokens of this batch won't be looked up again, so caching them would only grow the memory use with every batch
+                    clear_token_cache()
+                    if is_compiled_LIWC_lexicon(lexicons[4]):
+                        lexicons[4]["token_cache"].clear()
+
+                data = pd.DataFrame([feature_rows[sentence_hash] for sentence_hash in sentence_hashes], columns=FEATURE_COLUMNS)
+                data.insert(0, 'is_empowering', label)
+                writer.write_table(pa.Table.from_pandas(data, schema=schema, preserve_index=False))
+                num_rows += len(batch)
+                num_new_rows += len(new_sentences)
+                print(f"extracted features of {num_rows} sentences, {num_new_rows} of them new...")
+    feature_store["connection"].close()
+    os.replace(out_path + ".tmp", out_path)
+    return open_feature_dataset(out_path)
 
 def plot_data(plot_type, data, fig_title, subplot_names=None, num_rows=4, num_cols=5):
     assert plot_type == "boxplot" or plot_type == "pdf"
@@ -334,83 +712,132 @@ def plot_data(plot_type, data, fig_title, subplot_names=None, num_rows=4, num_co
     plt.show()
 
 
-def get_sentence_embeddings(sentences):
-    # using this library for the model: https://huggingface.co/sentence-transformers/all-mpnet-base-v2
-    # errors with installing the sentence_transformers library can be solved with this solution: https://github.com/UKPLab/sentence-transformers/issues/128
-    model = SentenceTransformer('all-mpnet-base-v2')
-    sentence_embeddings = []
-    for sentence in sentences:
-        print("Calling model.encode on one sentence")
-        embedding = model.encode(sentence)
-        sentence_embeddings.append((sentence, embedding))
-    return sentence_embeddings
-
 def cosine_similarity(vector1, vector2):
     return dot(vector1, vector2) / (norm(vector1) * norm(vector2))
 
 def get_most_similar_sentence(s1, embed1, sentence_embeddings):
-    highest_similarity = 0
-    matched_sentence = None
-    for index, row in sentence_embeddings.iterrows():
-        s2 = row['sentence']
-        embed2 = row['embedding']
-        similarity = cosine_similarity(embed1, embed2)
-        # print(f"found cosine similarity of {similarity}")
-        if similarity > highest_similarity:
-            highest_similarity = similarity
-            print(f"Highest similarity is now {highest_similarity}")
-            matched_sentence = s2
-    
-    # print(f"Sentence 1: {s1}")
-    # print(f"MATCHED WITH")
-    # print(f"Sentence 2: {matched_sentence}")
-    return matched_sentence
-
-def get_talkup_matched_samples(condescending_set, empowering_set):
-    talkdown_embeds = None
-    talkup_embeds = None
-
-    if exists("talkdown_embeddings.pkl"):
-        print("loading data...")
-        talkdown_embeds = pd.read_pickle("talkdown_embeddings.pkl")
-    else:
-        print("Calling get_sentence_embeddings for talkdown")
-        talkdown_embeds = get_sentence_embeddings(condescending_set)
-        # print("TALKDOWN EMBEDS")
-        # for item in talkdown_embeds:
-        #     print("\n\n")
-        #     print(item)
-        talkdown_embeds = pd.DataFrame(talkdown_embeds, columns =['sentence', 'embedding'])
-        talkdown_embeds.to_pickle("talkdown_embeddings.pkl")
-    
-    if exists("talkup_embeddings.pkl"):
-        print("loading data...")
-        talkup_embeds = pd.read_pickle("talkup_embeddings.pkl")
-    else:
-        print("Calling get_sentence_embeddings for talkup")
-        talkup_embeds = get_sentence_embeddings(empowering_set)
-        talkup_embeds = pd.DataFrame(talkup_embeds, columns =['sentence', 'embedding'])
-        talkup_embeds.to_pickle("talkup_embeddings.pkl")
+    """
+    Finds the sentence whose embedding is most cosine-similar to embed1
+    Args:
+        s1: the sentence embed1 belongs to
+        embed1: a numpy array
+        sentence_embeddings: a dataframe with 'sentence' and 'embedding' columns
+    Returns:
+        The most similar sentence (str), or None if no sentence has a positive similarity
+    """
+    best_indices, best_similarities = get_most_similar_indices(
+        np.asarray(embed1).reshape(1, -1), 
+        np.stack(sentence_embeddings['embedding'].values))
+    if best_similarities[0] <= 0:
+        return None
+    return sentence_embeddings['sentence'].iloc[best_indices[0]]
+
+def get_talkup_matched_samples(condescending_set, empowering_set, approximate=False, num_probes=16, one_to_one=None):
+    """
+    Matches every TalkDown sentence with its most similar TalkUp sentence, by cosine similarity of their sentence embeddings
+    Args:
+        condescending_set: a list of strings
+        empowering_set: a list of strings
+        approximate: if True, searches an IVF index over the TalkUp embeddings (see matching.build_ivf_index) instead of comparing with every TalkUp sentence.
+                     The index gets built once and saved to talkup_ivf_index.npz, next to the talkup_embeddings store, 
+                     and the matches are saved to talkup_matched_ivf{num_probes}.csv, apart from the exact ones in talkup_matched.csv
+        num_probes: the number of IVF clusters to search per TalkDown sentence when approximate is True; more is slower but closer to the exact matches
+        one_to_one: None to match every TalkDown sentence independently, which can match several of them with the same TalkUp sentence, 
+                    or "greedy" / "optimal" to match without replacement (see matching.get_one_to_one_matches). 
+                    One-to-one matches are saved to talkup_matched_{one_to_one}.csv, and approximate is ignored for them
+    Returns:
+        A list with the matched TalkUp sentence (str) of every TalkDown sentence
+    """
+    talkdown_hashes = hash_sentences(condescending_set)
+    talkup_hashes = hash_sentences(empowering_set)
 
     talkup_matched = []
+    # every kind of search gets its own files, so that one never gets mistaken for another
+    if one_to_one is not None:
+        mode, file_suffix = one_to_one, f"_{one_to_one}"
+    elif approximate:
+        mode, file_suffix = f"ivf:{num_probes}", f"_ivf{num_probes}"
+    else:
+        mode, file_suffix = "exact", ""
+    matched_filename = f"talkup_matched{file_suffix}.csv"
+    # independent matches are computed chunk by chunk, and every finished chunk is saved here, so an interrupted run resumes where it stopped
+    # and a run with more TalkDown or TalkUp sentences (appended to the end) only matches what's new
+    checkpoint_filename = f"talkup_matched{file_suffix}_checkpoint.csv"
+    # the saved matches are only reused if they were computed from exactly these sentences
+    source = get_matching_source(talkdown_hashes, talkup_hashes, mode)
+    if exists(matched_filename) and read_matching_source(matched_filename) is None and mode == "exact":
+        # exact matches saved before the matches had a source: they're taken to be for these sentences if there's one per TalkDown sentence,
+        # like the legacy pickled embeddings are, so that they don't get computed (and overwritten) again
+        legacy_matched = pd.read_csv(matched_filename, header=None)
+        if len(legacy_matched) == len(condescending_set):
+            print(f"adopting the matches in {matched_filename}, which were saved without a source...")
+            write_matching_source(matched_filename, source)
    
-    if exists("talkup_matched.csv"):
-        df = pd.read_csv("talkup_matched.csv")
-        talkup_matched = df.values.reshape(-1).tolist()
+    if exists(matched_filename) and read_matching_source(matched_filename) == source:
+        df = pd.read_csv(matched_filename, header=None)
+        talkup_matched = df[0].tolist()
     else:
-        for index, row in talkdown_embeds.iterrows():
-            # print(tup)
-            s1 = row['sentence']
-            embed1 = row['embedding']
-            print(f"TalkDown sentence: {s1}") #, \nembedding: {embed1}")
-            matched_sentence = get_most_similar_sentence(s1, embed1, talkup_embeds)
-            # print(f"\nTalkDown sentence: {s1}")
-            print(f"Matched with TalkUp sentence: {matched_sentence}")
-            talkup_matched.append(matched_sentence)
-
-        pd.DataFrame(talkup_matched).to_csv("talkup_matched.csv")
+        # the saved embeddings are memory-mapped (see embeddings.read_embedding_store), and only reused if they are for exactly these sentences; 
+        # when they aren't, only the sentences missing from the embedding cache get encoded again.
+        # Embeddings pickled by earlier versions get moved to the stores the first time
+        print("loading data...")
+        talkdown_embeds = load_or_generate_embedding_store("talkdown_embeddings", condescending_set, legacy_pickle_path="talkdown_embeddings.pkl")
+        talkup_embeds = load_or_generate_embedding_store("talkup_embeddings", empowering_set, legacy_pickle_path="talkup_embeddings.pkl")
+        talkdown_matrix = talkdown_embeds["embeddings"]
+        talkup_matrix = talkup_embeds["embeddings"]
+        talkup_sentences = talkup_embeds["sentences"]
+        print(f"matching {len(talkdown_matrix)} TalkDown sentences against {len(talkup_matrix)} TalkUp sentences...")
+        ivf_index = None
+        if one_to_one is None and approximate:
+            ivf_index = load_or_build_talkup_ivf_index(talkup_matrix, talkup_hashes)
+
+        if one_to_one is not None:
+            best_indices, best_similarities = get_one_to_one_matches(talkdown_matrix, talkup_matrix, method=one_to_one)
+        else:
+            best_indices, best_similarities = get_most_similar_indices_resumable(
+                talkdown_matrix, talkup_matrix, checkpoint_filename, ivf_index=ivf_index, num_probes=num_probes, 
+                query_keys=talkdown_hashes, candidate_keys=talkup_hashes)
+        # like before, a TalkDown sentence with no positively similar TalkUp sentence gets matched with None
+        talkup_matched = [
+            talkup_sentences[best_index] if best_similarity > 0 else None 
+            for best_index, best_similarity in zip(best_indices, best_similarities)]
+        print(f"mean similarity of the matches: {best_similarities.mean()}")
+
+        pd.DataFrame(talkup_matched).to_csv(matched_filename, index=False, header=False)
+        write_matching_source(matched_filename, source)
     
     return talkup_matched
 
+def load_or_build_talkup_ivf_index(talkup_matrix, talkup_hashes):
+    """
+    Returns:
+        The IVF index of the TalkUp embeddings (see matching.build_ivf_index), saved to talkup_ivf_index.npz the first time it gets built
+        and only reused if it was built from exactly these TalkUp sentences
+    """
+    talkup_key = get_dataset_key(talkup_hashes, [1] * len(talkup_hashes), "talkup_embeddings")
+    ivf_index = load_ivf_index("talkup_ivf_index.npz", talkup_key)
+    if ivf_index is None:
+        print("building the IVF index of the TalkUp embeddings...")
+        ivf_index = build_ivf_index(talkup_matrix)
+        save_ivf_index(ivf_index, "talkup_ivf_index.npz", talkup_key)
+    return ivf_index
+
+def get_talkup_ivf_recall_report(condescending_set, empowering_set, num_probes_options=IVF_RECALL_NUM_PROBES):
+    """
+    Compares the approximate matches of get_talkup_matched_samples(approximate=True) with the exact ones, for several numbers of probes, 
+    so that num_probes can be picked knowing what it costs in match quality (see matching.get_ivf_recall_report)
+    Args:
+        condescending_set: a list of strings
+        empowering_set: a list of strings
+        num_probes_options: the numbers of probes to measure
+    Returns:
+        The report of matching.get_ivf_recall_report, a dictionary per number of probes
+    """
+    talkdown_embeds = load_or_generate_embedding_store("talkdown_embeddings", condescending_set, legacy_pickle_path="talkdown_embeddings.pkl")
+    talkup_embeds = load_or_generate_embedding_store("talkup_embeddings", empowering_set, legacy_pickle_path="talkup_embeddings.pkl")
+    ivf_index = load_or_build_talkup_ivf_index(talkup_embeds["embeddings"], hash_sentences(talkup_embeds["sentences"]))
+    print(f"measuring the recall of the IVF index on {len(talkdown_embeds['sentences'])} TalkDown sentences against {len(talkup_embeds['sentences'])} TalkUp sentences...")
+    return get_ivf_recall_report(ivf_index, talkdown_embeds["embeddings"], talkup_embeds["embeddings"], num_probes_options)
+
 def get_talkup_random(empowering_set, k):
     return random.sample(empowering_set, k)
\ No newline at end of file